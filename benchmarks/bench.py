@@ -0,0 +1,229 @@
+'''
+Benchmarks of thetaexif on synthetic THETA images.
+
+Every case runs in a fresh process and reports the best time of a few runs
+and the peak memory traced by tracemalloc during one more run. Images are
+generated by thetaexif.tests.testdata, so no network access is needed.
+
+    $ python benchmarks/bench.py --sizes 1024x512 5376x2688
+'''
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from thetaexif import cli, projection  # noqa: E402
+from thetaexif.exif import ExifReader  # noqa: E402
+from thetaexif.tests import testdata  # noqa: E402
+
+CASES = collections.OrderedDict()
+
+
+def case(func):
+    '''
+    Register a benchmark.
+
+    `func(path, options)` prepares the work on the image at `path` and
+    returns a callable to measure and the number of items it processes.
+    Scratch files go to `options.workdir`.
+    '''
+    CASES[func.__name__] = func
+    return func
+
+
+@case
+def exif_parse(path, options):
+    return lambda: ExifReader(path), 1
+
+
+@case
+def exif_tags(path, options):
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    def run():
+        reader = ExifReader(data)
+        for ifd in (reader.makernote, reader.theta):
+            for key in ifd:
+                ifd[key]
+
+    return run, 1
+
+
+@case
+def getcoordinates(path, options):
+    with Image.open(path) as img:
+        w, h = img.size
+    r = projection.getpose(ExifReader(path), True).T
+    return lambda: projection.getcoordinates(
+        w, h, r, options.backend, maptype=options.map_type), 1
+
+
+@case
+def remap(path, options):
+    with Image.open(path) as img:
+        imgarray = np.asarray(img)
+    h, w = imgarray.shape[:2]
+    r = projection.getpose(ExifReader(path), True).T
+    coord = projection.getcoordinates(w, h, r, options.backend,
+                                      maptype=options.map_type)
+    return lambda: projection.remap(imgarray, coord), 1
+
+
+@case
+def rectify(path, options):
+    img = Image.open(path)
+    img.load()
+    return lambda: projection.rectify(
+        img, True, backend=options.backend, maptype=options.map_type), 1
+
+
+@case
+def cli_rectify(path, options):
+    images = []
+    for i in range(options.batch):
+        images.append(os.path.join(options.workdir, '{}.jpg'.format(i)))
+        shutil.copyfile(path, images[-1])
+    argv = ['rectify', '-c', '-e', '-j', str(options.jobs), '-d',
+            os.path.join(options.workdir, 'out')] + images
+    if options.backend:
+        argv += ['--backend', options.backend]
+    argv += ['--map-type', options.map_type]
+
+    def run():
+        with contextlib.redirect_stderr(io.StringIO()):
+            cli.parse(argv)
+
+    return run, options.batch
+
+
+def _measure(name, path, options):
+    with tempfile.TemporaryDirectory() as options.workdir:
+        func, items = CASES[name](path, options)
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        seconds = min(timer.repeat(options.repeat, number)) / number
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return seconds, items, peak
+
+
+def measure(name, path, options):
+    '''
+    Run the benchmark `name` on `path` in a new process.
+    '''
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=context) as executor:
+        seconds, items, peak = executor.submit(_measure, name, path,
+                                               options).result()
+    with Image.open(path) as img:
+        size = img.size
+    return {
+        'case': name,
+        'size': '{}x{}'.format(*size),
+        'seconds': seconds,
+        'items_per_second': items / seconds,
+        'peak_mb': peak / 2**20,
+    }
+
+
+def fixture(directory, size):
+    path = os.path.join(directory, 'theta-{}x{}.jpg'.format(*size))
+    if not os.path.exists(path):
+        testdata.make_image(path, size)
+    return path
+
+
+def size(value):
+    w, h = value.split('x')
+    return int(w), int(h)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='thetaexif benchmarks')
+    parser.add_argument('case',
+                        nargs='*',
+                        help='cases to run: {} (default: all)'.format(
+                            ', '.join(CASES)))
+    parser.add_argument('-s',
+                        '--sizes',
+                        nargs='+',
+                        type=size,
+                        default=[(1024, 512), (5376, 2688)],
+                        metavar='WxH',
+                        help='image sizes (default: 1024x512 5376x2688)')
+    parser.add_argument('-r',
+                        '--repeat',
+                        type=int,
+                        default=3,
+                        help='timed runs per case (default: %(default)s)')
+    parser.add_argument('--backend',
+                        choices=list(projection.BACKENDS),
+                        help='coordinate backend')
+    parser.add_argument('--map-type',
+                        choices=list(projection.MAP_TYPES),
+                        default='float32',
+                        help='coordinate map type (default: %(default)s)')
+    parser.add_argument('--batch',
+                        type=int,
+                        default=8,
+                        help='images per cli_rectify run '
+                        '(default: %(default)s)')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='cli_rectify worker processes, whose memory is '
+                        'not traced (default: 1)')
+    parser.add_argument('--fixtures',
+                        help='directory to keep generated images in')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='print one JSON object per result')
+    options = parser.parse_args(argv)
+    for name in options.case:
+        if name not in CASES:
+            parser.error('unknown case: {}'.format(name))
+
+    directory = options.fixtures or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok=True)
+    try:
+        if not options.json:
+            print('{:<16}{:>12}{:>12}{:>12}{:>12}'.format(
+                'case', 'size', 'time [s]', 'items/s', 'peak [MB]'))
+        for wh, name in itertools.product(options.sizes, options.case
+                                          or CASES):
+            result = measure(name, fixture(directory, wh), options)
+            if options.json:
+                print(json.dumps(result, sort_keys=True))
+            else:
+                print('{case:<16}{size:>12}{seconds:>12.4g}'
+                      '{items_per_second:>12.1f}{peak_mb:>12.1f}'.format(
+                          **result))
+            sys.stdout.flush()
+    finally:
+        if options.fixtures is None:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
+# cython: language_level=3
 cimport cython
-from libc.math cimport M_PI, sin, cos, atan2, asin
-cimport numpy as np
+from libc.math cimport M_PI, sin, cos, atan2, asin, fmin, fmax
 from cython.parallel import prange
 import numpy as np
 
+ctypedef fused real:
+    float
+    double
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def getcoordinates(int w, int h, np.ndarray[np.double_t, ndim=2] r):
+cdef void _fill(real[:, :, ::1] coord, double[:, ::1] r, int w, int h,
+                int start, double[::1] sin_theta,
+                double[::1] cos_theta) noexcept nogil:
     cdef double u0 = w / 2.
     cdef double v0 = h / 2.
     cdef double u2t = 2 * M_PI / w
@@ -15,26 +22,48 @@ def getcoordinates(int w, int h, np.ndarray[np.double_t, ndim=2] r):
     cdef double p2v = 1 / v2p
 
     cdef int u, v
-    cdef double phi, cos_phi, theta
+    cdef double phi, cos_phi
     cdef double xd, yd, zd, xs, ys, zs
+    cdef double r00 = r[0, 0], r01 = r[0, 1], r02 = r[0, 2]
+    cdef double r10 = r[1, 0], r11 = r[1, 1], r12 = r[1, 2]
+    cdef double r20 = r[2, 0], r21 = r[2, 1], r22 = r[2, 2]
 
-    cdef np.ndarray[np.float32_t, ndim=2] xx = np.empty((h, w), np.float32)
-    cdef np.ndarray[np.float32_t, ndim=2] yy = np.empty((h, w), np.float32)
-
-    for v in prange(h, nogil=True):
-        phi = (v - v0) * v2p
+    for v in prange(coord.shape[1]):
+        phi = (v + start - v0) * v2p
         cos_phi = cos(phi)
         yd = sin(phi)
-        for u in xrange(w):
-            theta = (u - u0) * u2t
-            xd = cos_phi * sin(theta)
-            zd = cos_phi * cos(theta)
+        for u in range(w):
+            xd = cos_phi * sin_theta[u]
+            zd = cos_phi * cos_theta[u]
 
-            xs = r[0, 0] * xd + r[0, 1] * yd + r[0, 2] * zd
-            ys = r[1, 0] * xd + r[1, 1] * yd + r[1, 2] * zd
-            zs = r[2, 0] * xd + r[2, 1] * yd + r[2, 2] * zd
+            xs = r00 * xd + r01 * yd + r02 * zd
+            ys = r10 * xd + r11 * yd + r12 * zd
+            zs = r20 * xd + r21 * yd + r22 * zd
+            ys = fmin(fmax(ys, -1), 1)
 
-            xx[v, u] = atan2(xs, zs) * t2u + u0
-            yy[v, u] = asin(ys) * p2v + v0
+            coord[0, v, u] = asin(ys) * p2v + v0
+            coord[1, v, u] = atan2(xs, zs) * t2u + u0
+
+
+def getcoordinates(int w, int h, double[:, ::1] r, int start, int stop,
+                   dtype=np.float32):
+    cdef double[::1] sin_theta = np.empty(w)
+    cdef double[::1] cos_theta = np.empty(w)
+    cdef double u2t = 2 * M_PI / w
+    cdef double theta
+    cdef int u
+    for u in range(w):
+        theta = (u - w / 2.) * u2t
+        sin_theta[u] = sin(theta)
+        cos_theta[u] = cos(theta)
 
-    return yy, xx
+    # Coordinates are computed in double and stored as dtype directly
+    dtype = np.dtype(dtype)
+    coord = np.empty((2, stop - start, w), dtype)
+    if dtype == np.float64:
+        _fill[double](coord, r, w, h, start, sin_theta, cos_theta)
+    elif dtype == np.float32:
+        _fill[float](coord, r, w, h, start, sin_theta, cos_theta)
+    else:
+        raise ValueError('Unsupported dtype: {}'.format(dtype))
+    return coord
@@ -1,4 +1,50 @@
-from setuptools import find_packages, setup
+import sys
+
+from setuptools import Extension, find_packages, setup
+from setuptools.command.build_ext import build_ext
+
+
+class optional_build_ext(build_ext):
+    """Build the compiled backend if possible, otherwise skip it."""
+    def run(self):
+        try:
+            super().run()
+        except Exception as e:
+            self.warn('compiled backend is disabled: {}'.format(e))
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception:
+            # Retry without OpenMP, e.g. for Apple clang
+            ext.extra_compile_args = []
+            ext.extra_link_args = []
+            try:
+                super().build_extension(ext)
+            except Exception as e:
+                self.warn('compiled backend is disabled: {}'.format(e))
+
+
+def extensions():
+    try:
+        import numpy
+        from Cython.Build import cythonize
+    except ImportError:
+        return []
+
+    if sys.platform == 'win32':
+        openmp = ['/openmp'], []
+    else:
+        openmp = ['-fopenmp'], ['-fopenmp']
+    ext = Extension('thetaexif._mapping', ['cy/mapping.pyx'],
+                    include_dirs=[numpy.get_include()],
+                    extra_compile_args=openmp[0],
+                    extra_link_args=openmp[1])
+    try:
+        return cythonize([ext])
+    except Exception:
+        return []
+
 
 setup(
     name='thetaexif',
@@ -19,12 +65,14 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Topic :: Utilities',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
     ],
     packages=find_packages(exclude=['*.tests']),
+    ext_modules=extensions(),
+    cmdclass={'build_ext': optional_build_ext},
     test_suite='thetaexif.tests',
-    install_requires=['numpy', 'scipy', 'pillow'],
+    python_requires='>=3.7',
+    install_requires=['numpy', 'pillow>=7'],
     entry_points={
         'console_scripts': ['theta-tool = thetaexif.cli:parse'],
     },
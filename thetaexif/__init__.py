@@ -1,5 +1,13 @@
 from . import tag
 from .exif import ExifReader
-from .projection import rectify
 
 __all__ = ['ExifReader', 'rectify', 'tag']
+
+
+def __getattr__(name):
+    # NumPy and Pillow are imported only when rectification is used
+    if name == 'rectify':
+        from .projection import rectify
+        return rectify
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
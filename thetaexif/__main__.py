@@ -3,4 +3,4 @@ import sys
 from . import cli
 
 if __name__ == '__main__':
-    cli.parse()
+    sys.exit(cli.parse())
@@ -0,0 +1,150 @@
+'''
+Coroutines to read EXIF and rectify images without blocking the event loop.
+
+Blocking work runs on `executor`, which defaults to the default executor of
+the loop. `rectify` reads, decodes, remaps and encodes images there, and
+`executor` may be a thread or a process pool; with a process pool, sources
+and results are sent between processes as bytes and the options must be
+picklable. `read_exif` reads paths there and needs a thread pool. Pass an
+`asyncio.BoundedSemaphore` to bound the images in flight across many
+callers, e.g. the requests of a web service.
+'''
+import asyncio
+import collections
+import io
+
+from .exif import ExifReader
+
+_BUFFERS = (bytes, bytearray, memoryview)
+_cache = None
+
+
+def _rectify(src, dst, exif, options):
+    from . import projection
+
+    global _cache
+    if 'cache' not in options:
+        # One cache per process, shared by the threads of an executor
+        if _cache is None:
+            _cache = projection.CoordinateCache()
+        options = dict(options, cache=_cache)
+
+    if isinstance(src, _BUFFERS):
+        src = io.BytesIO(src)
+    rectified = projection.rectify(src, **options)
+    if dst is not None:
+        projection.save(rectified, dst, exif)
+        return dst
+    buf = io.BytesIO()
+    projection.save(rectified, buf, exif)
+    return buf.getvalue()
+
+
+async def read_exif(src, executor=None):
+    '''
+    Return an `ExifReader` of a path or a buffer.
+
+    Paths are read on `executor`, which defaults to the default executor of
+    the loop and must not be a process pool, since readers refer to their
+    buffers. Buffers are parsed in place without copying.
+    '''
+    if isinstance(src, _BUFFERS):
+        return ExifReader(src)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, ExifReader, src)
+
+
+async def rectify(src,
+                  dst=None,
+                  exif=False,
+                  executor=None,
+                  semaphore=None,
+                  **options):
+    '''
+    Rectify a path or the bytes of a JPEG file on `executor`.
+
+    The result is saved to `dst` if given, and `dst` is returned. Otherwise
+    the encoded JPEG is returned as bytes. `options` are passed to
+    `projection.rectify`; unless `cache` is given, a coordinate cache shared
+    by the process is used. The call waits for `semaphore` before the image
+    is decoded.
+    '''
+    if isinstance(src, (bytearray, memoryview)):
+        # The buffer may be modified before the executor reads it
+        src = bytes(src)
+    loop = asyncio.get_running_loop()
+    if semaphore is None:
+        return await loop.run_in_executor(executor, _rectify, src, dst, exif,
+                                          options)
+    async with semaphore:
+        return await loop.run_in_executor(executor, _rectify, src, dst, exif,
+                                          options)
+
+
+async def _iterate(items):
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def _outcome(item, task):
+    try:
+        return item, await task, None
+    except Exception as e:
+        return item, None, e
+
+
+async def _ordered(func, items, inflight):
+    '''
+    Run `func` on `items` with at most `inflight` running at once.
+
+    Yields (item, result, error) in input order, where error is None on
+    success.
+    '''
+    pending = collections.deque()
+    try:
+        async for item in _iterate(items):
+            pending.append((item, asyncio.ensure_future(func(item))))
+            while pending and (pending[0][1].done()
+                               or len(pending) >= inflight):
+                yield await _outcome(*pending.popleft())
+        while pending:
+            yield await _outcome(*pending.popleft())
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+
+def read_exif_many(srcs, inflight=16, executor=None):
+    '''
+    Read many paths or buffers concurrently.
+
+    `srcs` may be an iterable or an async iterable. Yields (src, reader,
+    error) in input order, where error is None on success.
+    '''
+    return _ordered(lambda src: read_exif(src, executor), srcs, inflight)
+
+
+async def rectify_many(jobs,
+                       inflight=3,
+                       exif=False,
+                       executor=None,
+                       semaphore=None,
+                       **options):
+    '''
+    Rectify (src, dst) pairs concurrently through `rectify`.
+
+    `jobs` may be an iterable or an async iterable, and dst may be None to
+    get the encoded JPEG. At most `inflight` images of the batch are in
+    flight. Yields (src, result, error) in input order, where error is None
+    on success.
+    '''
+    def run(job):
+        src, dst = job
+        return rectify(src, dst, exif, executor, semaphore, **options)
+
+    async for (src, _), result, error in _ordered(run, jobs, inflight):
+        yield src, result, error
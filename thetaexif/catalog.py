@@ -0,0 +1,185 @@
+import concurrent.futures
+import json
+import math
+import numbers
+import os
+import sqlite3
+
+from .exif import ExifReader, metadata
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    error TEXT,
+    serial TEXT,
+    firmware TEXT,
+    zenith_z REAL,
+    zenith_x REAL,
+    tilt REAL,
+    compass REAL,
+    tags TEXT
+);
+CREATE INDEX IF NOT EXISTS images_serial ON images (serial);
+CREATE INDEX IF NOT EXISTS images_tilt ON images (tilt);
+'''
+
+COLUMNS = ('path', 'size', 'mtime_ns', 'error', 'serial', 'firmware',
+           'zenith_z', 'zenith_x', 'tilt', 'compass', 'tags')
+
+
+def _walk(root, onerror):
+    # Directories and entries which cannot be read, e.g. for permissions or
+    # because they vanished or are broken links, are passed to onerror
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError as e:
+        onerror(root, e)
+        return
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                st = None
+            elif os.path.splitext(entry.name)[1].lower() in ('.jpg', '.jpeg'):
+                st = entry.stat()
+            else:
+                continue
+        except OSError as e:
+            onerror(entry.path, e)
+            continue
+        if st is None:
+            yield from _walk(entry.path, onerror)
+        else:
+            yield entry.path, st
+
+
+def _isnumber(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _columns(data):
+    # Derived columns; malformed tags raise ValueError
+    makernote, theta = data['makernote'], data['theta']
+    columns = dict(serial=makernote.get('SerialNumber'),
+                   firmware=makernote.get('FirmwareVersion'))
+    if 'ZenithEs' in theta:
+        zenith = theta['ZenithEs']
+        if not (isinstance(zenith, list) and len(zenith) == 2
+                and all(_isnumber(v) for v in zenith)):
+            raise ValueError('Invalid ZenithEs: {!r}'.format(zenith))
+        z, x = zenith
+        columns['zenith_z'], columns['zenith_x'] = z, x
+        # Angle between the camera axis and the vertical
+        cos_tilt = math.cos(math.radians(z)) * math.cos(math.radians(x))
+        columns['tilt'] = math.degrees(math.acos(max(-1, min(1, cos_tilt))))
+    compass = theta.get('CompassEs')
+    if compass is not None and not _isnumber(compass):
+        raise ValueError('Invalid CompassEs: {!r}'.format(compass))
+    columns['compass'] = compass
+    columns['tags'] = json.dumps(data, sort_keys=True)
+    return columns
+
+
+def _record(path, st):
+    record = dict.fromkeys(COLUMNS)
+    record.update(path=path, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    try:
+        record.update(_columns(metadata(ExifReader(path))))
+    except (OSError, ValueError, KeyError) as e:
+        record['error'] = str(e)
+    return record
+
+
+class Catalog(object):
+    '''
+    SQLite catalogue of THETA tags.
+
+    `scan` indexes JPEG files under a directory and skips files whose size
+    and mtime are unchanged since the last scan. `select` queries the
+    `images` table, e.g. ``catalog.select('tilt > ?', 10)``.
+    '''
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def scan(self, root, jobs=8, batch=1000, onerror=None):
+        '''
+        Index JPEG files under `root` and forget the ones that disappeared.
+
+        Entries which cannot be listed or stat'ed are skipped and passed to
+        `onerror(path, error)` if given; their records are kept. Returns the
+        numbers of updated, unchanged, removed, failed and skipped files.
+        '''
+        root = os.path.abspath(root)
+        # Paths under root sort between root + sep and root + (sep + 1)
+        known = {
+            row['path']: (row['size'], row['mtime_ns'])
+            for row in self.db.execute(
+                'SELECT path, size, mtime_ns FROM images '
+                'WHERE path > ? AND path < ?',
+                (root + os.sep, root + chr(ord(os.sep) + 1)))
+        }
+
+        stats = dict(updated=0, unchanged=0, removed=0, failed=0, skipped=0)
+        skipped = []
+
+        def skip(path, error):
+            skipped.append(path)
+            stats['skipped'] += 1
+            if onerror is not None:
+                onerror(path, error)
+
+        changed = []
+        for path, st in _walk(root, skip):
+            if known.pop(path, None) == (st.st_size, st.st_mtime_ns):
+                stats['unchanged'] += 1
+            else:
+                changed.append((path, st))
+
+        sql = 'INSERT OR REPLACE INTO images ({}) VALUES ({})'.format(
+            ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            records = executor.map(lambda args: _record(*args), changed)
+            rows = []
+            for record in records:
+                stats['updated'] += 1
+                if record['error'] is not None:
+                    stats['failed'] += 1
+                rows.append(tuple(record[c] for c in COLUMNS))
+                if len(rows) >= batch:
+                    with self.db:
+                        self.db.executemany(sql, rows)
+                    rows = []
+            with self.db:
+                self.db.executemany(sql, rows)
+
+        removed = [
+            path for path in known if not any(
+                path == s or path.startswith(s + os.sep) for s in skipped)
+        ]
+        with self.db:
+            self.db.executemany('DELETE FROM images WHERE path = ?',
+                                ((path, ) for path in removed))
+        stats['removed'] = len(removed)
+        return stats
+
+    def select(self, where='1', *params):
+        '''
+        Return rows of `images` matching the SQL expression `where`.
+        '''
+        return self.db.execute(
+            'SELECT * FROM images WHERE {} ORDER BY path'.format(where),
+            params).fetchall()
@@ -1,34 +1,374 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import fractions
+import glob
+import itertools
+import json
 import os
+import signal
+import sys
+import threading
+import time
 
-from . import projection, tag
-from .exif import ExifReader, TagReader
+from . import tag
+from .constants import BACKEND_NAMES, MAP_TYPES, THUMBNAIL_METHODS
+from .exif import ExifReader, TagReader, metadata, patch as patch_exif
+from .stats import Stats
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    '''
+    Executor running tasks in the calling process on submission.
+    '''
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+_cache = None
+
+
+def _init_worker(cache_size,
+                 cache_dir,
+                 backend,
+                 maptype='float32',
+                 cache_dir_size=4096):
+    from . import projection
+
+    global _cache
+    _cache = projection.CoordinateCache(cache_size << 20,
+                                        directory=cache_dir,
+                                        backend=backend,
+                                        maptype=maptype,
+                                        maxdiskbytes=cache_dir_size << 20)
+
+
+def _init_watch_worker(*initargs):
+    # Interrupts from the terminal reach the workers too; the daemon finishes
+    # the images being written instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(*initargs)
+
+
+def _rectify_file(src, dst, exif, stats, options):
+    from . import projection
+
+    record = Stats() if stats else None
+    rectified = projection.rectify(src, cache=_cache, stats=record, **options)
+    projection.save(rectified, dst, exif, record)
+    return record
+
+
+def destinations(paths, outdir=None):
+    '''
+    Return output paths for `paths`, numbering duplicates in input order.
+    '''
+    result = []
+    seen = set()
+    for src in paths:
+        if outdir:
+            dst = os.path.join(outdir, os.path.basename(src))
+        else:
+            base, ext = os.path.splitext(src)
+            dst = base + '_rectified' + ext
+
+        base, ext = os.path.splitext(dst)
+        i = 1
+        while os.path.normcase(os.path.abspath(dst)) in seen:
+            dst = '{}_{}{}'.format(base, i, ext)
+            i += 1
+        seen.add(os.path.normcase(os.path.abspath(dst)))
+        result.append(dst)
+    return result
+
+
+def _printstats(fmt, stats, path=None):
+    if fmt == 'json':
+        print(json.dumps({'path': path, 'stages': stats.asdict()},
+                         sort_keys=True))
+    else:
+        print(stats.format(), file=sys.stderr)
+
+
+def _rectify_options(args):
+    '''
+    Return the options of `projection.rectify` and the arguments of
+    `_init_worker` given by `args`.
+    '''
+    from . import projection
+
+    if args.scale is not None and args.size is not None:
+        raise ValueError('--scale cannot be combined with --size')
+    projection.getbackend(args.backend)
+
+    options = dict(compass=args.compass,
+                   memory=args.memory << 20 if args.memory else None,
+                   threads=args.threads,
+                   thumbnail=args.thumbnail,
+                   scale=args.scale,
+                   output_size=args.size,
+                   maptype=args.map_type)
+    initargs = (args.cache_size, args.cache_dir, args.backend, args.map_type,
+                args.cache_dir_size)
+    return options, initargs
 
 
 def rectify(args):
+    from . import pipeline
+
     if args.dir and not os.path.exists(args.dir):
         os.makedirs(args.dir)
 
-    for src in args.image:
-        if args.dir:
-            dst = os.path.join(args.dir, os.path.basename(src.name))
+    try:
+        options, initargs = _rectify_options(args)
+    except ValueError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    jobs = args.jobs or os.cpu_count() or 1
+    if args.pipeline:
+        if jobs != 1:
+            print('Error: --pipeline cannot be combined with --jobs',
+                  file=sys.stderr)
+            return 1
+        _init_worker(*initargs)
+        executor = pipeline.rectifier(exif=args.exif,
+                                      cache=_cache,
+                                      backend=args.backend,
+                                      inflight=args.inflight,
+                                      stats=bool(args.stats),
+                                      **options)
+        submit = executor.submit
+        inflight = args.inflight
+    else:
+        if jobs == 1:
+            executor = SerialExecutor(_init_worker, initargs)
+            inflight = 1
         else:
-            base, ext = os.path.splitext(src.name)
-            dst = base + '_rectified' + ext
+            executor = concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=_init_worker, initargs=initargs)
+            # Keep the workers busy while results are collected
+            inflight = 2 * jobs
+
+        def submit(job):
+            return executor.submit(_rectify_file, *job, args.exif,
+                                   bool(args.stats), options)
+
+    queue = collections.deque(
+        zip(args.image, destinations(args.image, args.dir)))
+    total = len(queue)
+    attempts = collections.Counter()
+    pending = {}
+    done = failed = 0
+    total_stats = Stats()
+    start = time.perf_counter()
+    with executor:
+        while queue or pending:
+            while queue and len(pending) < inflight:
+                job = queue.popleft()
+                pending[submit(job)] = job
+
+            finished, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                src, dst = pending.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    attempts[src] += 1
+                    if (args.on_error == 'retry'
+                            and attempts[src] <= args.retries):
+                        queue.appendleft((src, dst))
+                        continue
+                    failed += 1
+                    print('Error: {}: {}'.format(src, e), file=sys.stderr)
+                    if args.on_error == 'abort':
+                        queue.clear()
+                else:
+                    done += 1
+                    print('[{}/{}] {} -> {}'.format(done + failed, total, src,
+                                                    dst),
+                          file=sys.stderr)
+                    if record is not None:
+                        total_stats.merge(record)
+                        _printstats(args.stats, record, src)
+
+    elapsed = time.perf_counter() - start
+    print('{} rectified, {} failed in {:.1f} s ({:.2f} images/s)'.format(
+        done, failed, elapsed, done / elapsed if elapsed else 0),
+          file=sys.stderr)
+    if args.stats:
+        _printstats(args.stats, total_stats)
+
+    return 1 if failed else 0
+
+
+def watch(args):
+    from .watch import Ingest, Spool, serve
+
+    if args.directory is None and args.socket is None:
+        print('Error: give a directory or --socket', file=sys.stderr)
+        return 1
+    if args.directory is not None:
+        if not os.path.isdir(args.directory):
+            print('Error: {}: not a directory'.format(args.directory),
+                  file=sys.stderr)
+            return 1
+        if os.path.exists(args.dir) and os.path.samefile(
+                args.directory, args.dir):
+            print('Error: --dir must differ from the watched directory',
+                  file=sys.stderr)
+            return 1
+    try:
+        options, initargs = _rectify_options(args)
+    except ValueError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    os.makedirs(args.dir, exist_ok=True)
 
-        rectified = projection.rectify(src, args.compass)
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs == 1:
+        executor = SerialExecutor(_init_worker, initargs)
+    else:
+        # Workers keep their imports and coordinate cache between images
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=_init_watch_worker, initargs=initargs)
 
-        params = {}
-        if args.exif:
-            params['exif'] = rectified.info['exif']
+    def submit(src, dst):
+        return executor.submit(_rectify_file, src, dst, args.exif, False,
+                               options)
+
+    def log(src, dst, error):
+        if error is None:
+            print('{} -> {}'.format(src, dst), file=sys.stderr)
+        else:
+            print('Error: {}: {}'.format(src, error), file=sys.stderr)
+
+    def report():
+        line = ('{queued} queued, {running} running, {done} rectified, '
+                '{failed} failed ({recent_images_per_second:.2f} images/s)')
+        print(line.format(**ingest.counters()), file=sys.stderr)
+
+    ingest = Ingest(submit, args.dir, 2 * jobs if jobs > 1 else 1, log)
+    spool = None
+    if args.directory is not None:
+        spool = Spool(args.directory, settle=not args.once)
+    reported = time.monotonic()
+
+    def poll():
+        nonlocal reported
+        if spool is not None:
+            for path in spool.poll():
+                try:
+                    ingest.add(path, force=False)
+                except ValueError as e:
+                    print('Error: {}: {}'.format(path, e), file=sys.stderr)
+        if args.report and time.monotonic() - reported >= args.report:
+            report()
+            reported = time.monotonic()
+
+    server = None
+    if args.socket is not None:
+        try:
+            server = serve(ingest, args.socket)
+        except ValueError as e:
+            error = e
+        except OSError as e:
+            error = '{}: {}'.format(args.socket, e)
+        if server is None:
+            executor.shutdown()
+            print('Error: {}'.format(error), file=sys.stderr)
+            return 1
+
+    def interrupt(signum, frame):
+        # Finish the images being written. A second interrupt aborts.
+        ingest.stop()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handlers[signum] = signal.signal(signum, interrupt)
+    try:
+        with executor:
+            ingest.run(poll, args.interval, args.once)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(args.socket)
+
+    report()
+    return 1 if args.once and ingest.failed else 0
 
-        with open(dst, 'wb') as fp:
-            fp = projection.NonJFIFHeaderFile(fp)
-            rectified.save(fp, 'JPEG', **params)
 
-        src.close()
+def patch(args):
+    if args.zenith is None and args.compass is None and not args.thumbnail:
+        print('Error: nothing to patch')
+        return 1
+
+    ret = 0
+    for path in args.image:
+        try:
+            patch_exif(path, args.zenith, args.compass, args.thumbnail)
+        except (OSError, ValueError, KeyError) as e:
+            print('Error: {}: {}'.format(path, e))
+            ret = 1
+
+    return ret
 
-    return 0
+
+def expand(paths):
+    '''
+    Expand directories and glob patterns into JPEG file paths.
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg'):
+                        yield os.path.join(root, name)
+        elif any(c in path for c in '*?['):
+            yield from expand(sorted(glob.glob(path, recursive=True)))
+        else:
+            yield path
+
+
+def _readinfo(path, fmt):
+    try:
+        reader = ExifReader(path)
+        if fmt == 'text':
+            makernote = dict(reader.makernote.items())
+            theta = dict(reader.theta.items())
+            return path, (makernote, theta), None
+        return path, metadata(reader), None
+    except (OSError, ValueError, KeyError) as e:
+        return path, None, e
+
+
+def _csvcolumns():
+    columns = ['path', 'error']
+    for prefix, tags in (('makernote', tag.MARKERNOTE_TAGS),
+                         ('theta', tag.THETASUBDIR_TGAS)):
+        for k, name in tags.items():
+            if k not in TagReader.SUBDIR_HEADER:
+                columns.append('{}.{}'.format(prefix, name))
+    return columns
 
 
 def info(args):
@@ -49,21 +389,156 @@ def info(args):
             line += ': {}'.format(v)
             print(line)
 
-    try:
-        reader = ExifReader(args.image)
-        makernote = reader.makernote
-        theta = reader.theta
-    except ValueError as e:
-        print('Error:', e)
-        return 1
+    paths = list(expand(args.image))
+    if args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout,
+                                _csvcolumns(),
+                                extrasaction='ignore')
+        writer.writeheader()
+
+    ret = 0
+    jobs = args.jobs or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        results = executor.map(_readinfo, paths,
+                               itertools.repeat(args.format))
+        for i, (path, data, error) in enumerate(results):
+            if error is not None:
+                ret = 1
+
+            if args.format == 'jsonl':
+                if error is None:
+                    record = dict(path=path, **data)
+                else:
+                    record = {'path': path, 'error': str(error)}
+                print(json.dumps(record, sort_keys=True))
+            elif args.format == 'csv':
+                row = {'path': path}
+                if error is None:
+                    for prefix, values in data.items():
+                        for name, value in values.items():
+                            if isinstance(value, list):
+                                value = ' '.join(map(str, value))
+                            row['{}.{}'.format(prefix, name)] = value
+                else:
+                    row['error'] = str(error)
+                writer.writerow(row)
+            else:
+                if len(paths) > 1:
+                    if i:
+                        print()
+                    print('==> {} <=='.format(path))
+                if error is not None:
+                    print('Error:', error)
+                    continue
+                makernote, theta = data
+                print('RICOH Marker Note')
+                formatter(makernote, tag.MARKERNOTE_TAGS)
+                print()
+                print('THETA Subdir')
+                formatter(theta, tag.THETASUBDIR_TGAS)
+
+    return ret
+
+
+def index(args):
+    from . import catalog
+
+    def onerror(path, error):
+        print('Error: {}: {}'.format(path, error), file=sys.stderr)
+
+    ret = 0
+    with catalog.Catalog(args.database) as db:
+        for path in args.path:
+            stats = db.scan(path,
+                            args.jobs or os.cpu_count() or 1,
+                            onerror=onerror)
+            print('{}: {updated} updated, {unchanged} unchanged, '
+                  '{removed} removed, {failed} failed, '
+                  '{skipped} skipped'.format(path, **stats),
+                  file=sys.stderr)
+            if stats['skipped']:
+                ret = 1
+
+        if args.where:
+            for row in db.select(args.where):
+                print(row['path'])
+
+    return ret
 
-    print('RICOH Marker Note')
-    formatter(makernote, tag.MARKERNOTE_TAGS)
-    print()
-    print('THETA Subdir')
-    formatter(theta, tag.THETASUBDIR_TGAS)
 
-    return 0
+def _jobs(value):
+    jobs = int(value)
+    if jobs < 0:
+        raise argparse.ArgumentTypeError('must be 0 or more')
+    return jobs
+
+
+def _add_rectify_arguments(parser):
+    parser.add_argument('-c',
+                        '--compass',
+                        action='store_true',
+                        help='use compass')
+    parser.add_argument('-e',
+                        '--exif',
+                        action='store_true',
+                        help='write EXIF')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1024,
+        metavar='MB',
+        help='memory limit of the coordinate cache (default: %(default)s)')
+    parser.add_argument(
+        '--cache-dir', help='directory to store coordinate grids persistently')
+    parser.add_argument(
+        '--cache-dir-size',
+        type=int,
+        default=4096,
+        metavar='MB',
+        help='size limit of --cache-dir, evicting the least recently used '
+        'grids (default: %(default)s)')
+    parser.add_argument(
+        '--backend',
+        choices=BACKEND_NAMES,
+        help='coordinate backend (default: fastest available)')
+    parser.add_argument(
+        '--map-type',
+        choices=list(MAP_TYPES),
+        default='float32',
+        help='coordinate map type; fixed takes 6 bytes per pixel and float32 '
+        '8 (default: %(default)s)')
+    parser.add_argument(
+        '-m',
+        '--memory',
+        type=int,
+        metavar='MB',
+        help='remap in bands using at most this much memory for coordinates')
+    parser.add_argument(
+        '-t',
+        '--threads',
+        type=int,
+        help='number of threads to rectify each image')
+    parser.add_argument(
+        '-s',
+        '--scale',
+        type=float,
+        help='scale the output, e.g. 0.25 for a quarter-size preview')
+    parser.add_argument('--size',
+                        nargs=2,
+                        type=int,
+                        metavar=('W', 'H'),
+                        help='output size in pixels')
+    parser.add_argument(
+        '--thumbnail',
+        choices=THUMBNAIL_METHODS,
+        default='grid',
+        help='how to regenerate the EXIF thumbnail (default: %(default)s)')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=_jobs,
+        default=1,
+        help='number of worker processes, 0 for all CPUs (default: 1)')
 
 
 def parse(argv=None):
@@ -75,28 +550,133 @@ def parse(argv=None):
     # Rectify
     parser_rectify = subparsers.add_parser('rectify', help='rectify image')
     parser_rectify.set_defaults(func=rectify)
-    parser_rectify.add_argument('image',
-                                nargs='+',
-                                type=argparse.FileType('rb'),
-                                help='path to image')
-    parser_rectify.add_argument('-c',
-                                '--compass',
-                                action='store_true',
-                                help='use compass')
+    parser_rectify.add_argument('image', nargs='+', help='path to image')
+    _add_rectify_arguments(parser_rectify)
     parser_rectify.add_argument(
         '-d', '--dir', help='output directory (default: source directory)')
-    parser_rectify.add_argument('-e',
-                                '--exif',
-                                action='store_true',
-                                help='write EXIF')
+    parser_rectify.add_argument(
+        '--on-error',
+        choices=['abort', 'skip', 'retry'],
+        default='abort',
+        help='what to do when an image fails (default: %(default)s)')
+    parser_rectify.add_argument(
+        '--retries',
+        type=int,
+        default=2,
+        help='number of retries with --on-error=retry (default: %(default)s)')
+    parser_rectify.add_argument(
+        '-p',
+        '--pipeline',
+        action='store_true',
+        help='overlap decoding, remapping and encoding on threads')
+    parser_rectify.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=['text', 'json'],
+        help='print wall and CPU time of each stage per image and in total, '
+        'as tables on stderr or JSON Lines on stdout with a null path for '
+        'the total; peak allocations need PYTHONTRACEMALLOC=1')
+    parser_rectify.add_argument(
+        '--inflight',
+        type=int,
+        default=3,
+        help='maximum number of images in the pipeline (default: %(default)s)')
+
+    # Watch
+    parser_watch = subparsers.add_parser(
+        'watch',
+        help='rectify images arriving in a directory or on a unix socket')
+    parser_watch.set_defaults(func=watch)
+    parser_watch.add_argument('directory',
+                              nargs='?',
+                              help='spool directory to poll for JPEG files')
+    parser_watch.add_argument('-d',
+                              '--dir',
+                              required=True,
+                              help='output directory')
+    _add_rectify_arguments(parser_watch)
+    parser_watch.add_argument(
+        '--socket',
+        help='unix socket accepting absolute paths and "stats", one per line')
+    parser_watch.add_argument(
+        '-i',
+        '--interval',
+        type=float,
+        default=2.0,
+        help='seconds between polls; files are rectified once they are '
+        'unchanged for one interval (default: %(default)s)')
+    parser_watch.add_argument(
+        '--report',
+        type=float,
+        default=60.0,
+        metavar='SECONDS',
+        help='print the counters periodically, 0 to disable '
+        '(default: %(default)s)')
+    parser_watch.add_argument(
+        '--once',
+        action='store_true',
+        help='rectify the files present now and exit')
+
+    # Patch
+    parser_patch = subparsers.add_parser(
+        'patch', help='overwrite pose tags in place without re-encoding')
+    parser_patch.set_defaults(func=patch)
+    parser_patch.add_argument('image', nargs='+', help='path to image')
+    parser_patch.add_argument('-z',
+                              '--zenith',
+                              nargs=2,
+                              type=fractions.Fraction,
+                              metavar=('Z', 'X'),
+                              help='zenith angles in degrees')
+    parser_patch.add_argument('-c',
+                              '--compass',
+                              type=fractions.Fraction,
+                              help='compass angle in degrees')
+    parser_patch.add_argument('-t',
+                              '--thumbnail',
+                              action='store_true',
+                              help='regenerate the EXIF thumbnail')
 
     # Info
     parser_info = subparsers.add_parser('info',
                                         description='display THETA EXIF tag')
     parser_info.set_defaults(func=info)
     parser_info.add_argument('image',
-                             type=argparse.FileType('rb'),
-                             help='path to image')
+                             nargs='+',
+                             help='path to image, directory or glob pattern')
+    parser_info.add_argument('-f',
+                             '--format',
+                             choices=['text', 'jsonl', 'csv'],
+                             default='text',
+                             help='output format (default: %(default)s)')
+    parser_info.add_argument(
+        '-j',
+        '--jobs',
+        type=_jobs,
+        default=8,
+        help='number of files read concurrently, 0 for all CPUs '
+        '(default: %(default)s)')
+
+    # Index
+    parser_index = subparsers.add_parser(
+        'index', help='index THETA tags into an SQLite catalogue')
+    parser_index.set_defaults(func=index)
+    parser_index.add_argument('database', help='path to catalogue')
+    parser_index.add_argument('path',
+                              nargs='*',
+                              help='directory to scan incrementally')
+    parser_index.add_argument(
+        '-w',
+        '--where',
+        help='print paths matching an SQL condition, e.g. "tilt > 10"')
+    parser_index.add_argument(
+        '-j',
+        '--jobs',
+        type=_jobs,
+        default=8,
+        help='number of files read concurrently, 0 for all CPUs '
+        '(default: %(default)s)')
 
     args = parser.parse_args(argv)
     return args.func(args)
@@ -0,0 +1,15 @@
+'''
+Option values shared by `projection` and the command line.
+
+This module does not import NumPy or Pillow, so that the command line can
+check its arguments without them.
+'''
+import collections
+
+# Coordinate backends; projection.BACKENDS has the available ones
+BACKEND_NAMES = ('numpy', 'compiled')
+# Coordinate map types and their bytes per output pixel
+MAP_TYPES = collections.OrderedDict([('float32', 8), ('fixed', 6),
+                                     ('float64', 16)])
+# Ways to regenerate the EXIF thumbnail
+THUMBNAIL_METHODS = ('grid', 'reduce')
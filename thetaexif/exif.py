@@ -4,16 +4,28 @@
 # - http://www.sno.phy.queensu.ca/~phil/exiftool/TagNames/Ricoh.html
 # - https://github.com/atotto/ricoh-theta-tools
 
-import collections
+import array
+import collections.abc
 import fractions
 import io
+import mmap
+import os
+import shutil
+import stat
 import struct
-
-from PIL import Image
+import sys
+import tempfile
 
 from . import tag
 
 
+def _isimage(obj):
+    # Pillow is imported only when images are used, and a Pillow image cannot
+    # exist before that
+    module = sys.modules.get('PIL.Image')
+    return module is not None and isinstance(obj, module.Image)
+
+
 class Handler(object):
     TABLE = {
         1: 'B',
@@ -33,25 +45,43 @@ class Handler(object):
     def __init__(self, typeid, formatter):
         self.typeid = typeid
         self.formatter = formatter
+        self.endian = formatter.format[:1]
+        self.code = formatter.format[1:]
 
     @property
     def size(self):
         return self.formatter.size
 
-    def read(self, fp):
-        unpacked = self.formatter.unpack(fp.read(self.size))
-        if len(unpacked) == 1:
-            return unpacked[0]
-        else:
-            return fractions.Fraction(unpacked[0], unpacked[1])
-
-    def write(self, fp, value):
+    def unpack(self, data, num):
+        '''
+        Decode `num` values from `data` with a single struct call.
+        '''
+        if self.typeid in (2, 7):
+            return bytes(data[:num])
+        fmt = '{}{}{}'.format(self.endian, num * len(self.code), self.code[0])
+        unpacked = struct.unpack_from(fmt, data)
         if self.typeid in (5, 10):
-            value = fractions.Fraction(value)
-            packed = self.formatter.pack(value.numerator, value.denominator)
-        else:
-            packed = self.formatter.pack(value)
-        fp.write(packed)
+            if 0 in unpacked[1::2]:
+                raise ValueError('Invalid rational.')
+            return tuple(
+                fractions.Fraction(n, d)
+                for n, d in zip(unpacked[::2], unpacked[1::2]))
+        return unpacked
+
+    def pack(self, values):
+        '''
+        Encode a sequence of values with a single struct call.
+        '''
+        if self.typeid in (2, 7):
+            return bytes(values)
+        if self.typeid in (5, 10):
+            flat = []
+            for value in values:
+                value = fractions.Fraction(value)
+                flat += [value.numerator, value.denominator]
+            values = flat
+        fmt = '{}{}{}'.format(self.endian, len(values), self.code[0])
+        return struct.pack(fmt, *values)
 
     @classmethod
     def build_handler(cls, endian=''):
@@ -66,16 +96,55 @@ Handler.lehandlers = Handler.build_handler('<')
 Handler.behandlers = Handler.build_handler('>')
 
 
+class Buffer(object):
+    '''
+    Byte buffer of a TIFF structure.
+
+    Reads are served from a memoryview of the source. Unless `inplace` is
+    True, the source is copied into a bytearray on the first write.
+    '''
+    def __init__(self, data, inplace=False):
+        self.view = memoryview(data).cast('B')
+        self.writable = inplace and not self.view.readonly
+
+    def __len__(self):
+        return len(self.view)
+
+    def unpack(self, formatter, offset):
+        if offset + formatter.size > len(self.view):
+            raise ValueError('Offset out of range.')
+        return formatter.unpack_from(self.view, offset)
+
+    def write(self, offset, data):
+        if offset + len(data) > len(self.view):
+            raise ValueError('Offset out of range.')
+        if not self.writable:
+            self.view = memoryview(bytearray(self.view))
+            self.writable = True
+        self.view[offset:offset + len(data)] = data
+
+    def replace(self, offset, data):
+        '''
+        Replace everything from `offset` to the end with `data`.
+        '''
+        buf = bytearray(self.view[:offset])
+        buf += data
+        self.view = memoryview(buf)
+        self.writable = True
+
+    def release(self):
+        self.view.release()
+
+
 class TIFFHeader(object):
-    def __init__(self, fp):
-        self.endian = fp.read(2)
+    def __init__(self, buf):
+        self.endian = bytes(buf.view[:2])
         if self.endian not in (b'II', b'MM'):
             raise ValueError('endian must be II or MM: {}'.format(self.endian))
-        tiff_code = self.u16(fp)
+        tiff_code = self.u16(buf, 2)
         if tiff_code != 0x002A:
             raise ValueError('Invalid TIFF header.')
-        self.zeroth_ifd_offset = self.u32(fp)
-        fp.seek(self.zeroth_ifd_offset)
+        self.zeroth_ifd_offset = self.u32(buf, 4)
 
     @property
     def handlers(self):
@@ -84,16 +153,14 @@ class TIFFHeader(object):
         elif self.endian == b'MM':
             return Handler.behandlers
 
-    @property
-    def u16(self):
-        return self.handlers[3].read
+    def u16(self, buf, offset):
+        return buf.unpack(self.handlers[3].formatter, offset)[0]
 
-    @property
-    def u32(self):
-        return self.handlers[4].read
+    def u32(self, buf, offset):
+        return buf.unpack(self.handlers[4].formatter, offset)[0]
 
 
-class TagReader(collections.MutableMapping):
+class TagReader(collections.abc.MutableMapping):
     '''
     IFD reader class.
     '''
@@ -104,34 +171,60 @@ class TagReader(collections.MutableMapping):
         tag.THETA_SUBDIR: 0
     }
 
-    def __init__(self, fp, header=None):
-        self.fp = fp
-        self.tags = {}
+    ENTRY = struct.Struct('HHI4s')
+
+    def __init__(self, buf, offset=None, header=None):
+        self.buf = buf
         self.data = {}
         if header is None:
-            self.header = TIFFHeader(fp)
-        else:
-            self.header = header
-
-        for i in range(header.u16(fp)):
-            tagid = header.u16(fp)
-            tagtype = header.u16(fp)
+            header = TIFFHeader(buf)
+        if offset is None:
+            offset = header.zeroth_ifd_offset
+        self.header = header
+
+        # Entries are kept in parallel arrays indexed through _index
+        self._index = {}
+        self._types = array.array('H')
+        self._counts = array.array('I')
+        self._offsets = array.array('I')
+
+        handlers = header.handlers
+        u32 = handlers[4].formatter
+        entry = struct.Struct(u32.format[:1] + self.ENTRY.format)
+        count = header.u16(buf, offset)
+        start = offset + 2
+        end = start + entry.size * count
+        if end + u32.size > len(buf):
+            raise ValueError('Truncated IFD.')
+
+        for i, (tagid, tagtype, num, value) in enumerate(
+                entry.iter_unpack(buf.view[start:end])):
             if tagid == 0 and tagtype == 0:
                 continue
             try:
-                handler = header.handlers[tagtype]
+                handler = handlers[tagtype]
             except KeyError:
                 raise ValueError('Invalid data type.')
-            num = header.u32(fp)
             if handler.size * num > 4:
-                offset = header.u32(fp)
+                offset = u32.unpack(value)[0]
             else:
-                offset = fp.tell()
-                fp.seek(4, io.SEEK_CUR)
+                offset = start + entry.size * i + 8
 
-            self.tags[tagid] = (handler, num, offset)
+            self._index[tagid] = len(self._types)
+            self._types.append(tagtype)
+            self._counts.append(num)
+            self._offsets.append(offset)
 
-        self.nextifd_offset = header.u32(fp)
+        self.nextifd_offset = buf.unpack(u32, end)[0]
+
+    @property
+    def tags(self):
+        return {key: self._entry(key) for key in self._index}
+
+    def _entry(self, key):
+        i = self._index[key]
+        return (self.header.handlers[self._types[i]], self._counts[i],
+                self._offsets[i])
 
     def __str__(self):
         return str(self.asdict())
@@ -140,33 +233,44 @@ class TagReader(collections.MutableMapping):
         try:
             return self.data[key]
         except KeyError:
-            handler, num, offset = self.tags[key]
-            self.fp.seek(offset)
-            value = tuple(handler.read(self.fp) for _ in range(num))
+            handler, num, offset = self._entry(key)
+            size = handler.size * num
+            if offset + size > len(self.buf):
+                raise ValueError('Offset out of range.')
+            value = handler.unpack(self.buf.view[offset:offset + size], num)
             if handler.typeid == 2:
-                value = b''.join(value[:-1])
-            elif handler.typeid == 7:
-                value = b''.join(value)
-            elif len(value) == 1:
+                value = value[:-1]
+            elif handler.typeid != 7 and len(value) == 1:
                 value = value[0]
 
             if key in self.SUBDIR_HEADER:
-                self.fp.seek(value + self.SUBDIR_HEADER[key])
-                self.data[key] = TagReader(self.fp, self.header)
+                if not isinstance(value, int):
+                    raise ValueError('Invalid subdir offset.')
+                self.data[key] = TagReader(self.buf,
+                                           value + self.SUBDIR_HEADER[key],
+                                           self.header)
             else:
                 self.data[key] = value
             return self.data[key]
 
-    def __setitem__(self, key, values):
-        handler, num, offset = self.tags[key]
+    def encode(self, key, values):
+        '''
+        Return the bytes which `values` are written as, without writing them.
+        '''
+        handler, num, offset = self._entry(key)
         if not isinstance(values, collections.abc.Sized):
             values = (values, )
         if num != len(values):
             raise ValueError('Invalid length of values.')
+        try:
+            return handler.pack(values)
+        except (struct.error, TypeError) as e:
+            raise ValueError('Invalid value of tag 0x{:04x}: {}'.format(
+                key, e))
 
-        self.fp.seek(offset)
-        for value in values:
-            handler.write(self.fp, value)
+    def __setitem__(self, key, values):
+        data = self.encode(key, values)
+        self.buf.write(self.getoffset(key), data)
 
         if key in self.data:
             del self.data[key]
@@ -175,14 +279,23 @@ class TagReader(collections.MutableMapping):
         raise NotImplementedError
 
     def __iter__(self):
-        return iter(self.tags)
+        return iter(self._index)
 
     def __len__(self):
-        return len(self.tags)
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
 
     def getoffset(self, key):
-        handler, num, offset = self.tags[key]
-        return offset
+        return self._offsets[self._index[key]]
+
+    def getspan(self, key):
+        '''
+        Return the offset and the byte length of the value.
+        '''
+        handler, num, offset = self._entry(key)
+        return offset, handler.size * num
 
     def asdict(self):
         '''
@@ -200,34 +313,241 @@ class TagReader(collections.MutableMapping):
         return d
 
 
+def _bufferreader(buf):
+    view = memoryview(buf).cast('B')
+
+    def read(offset, size):
+        return view[offset:offset + size]
+
+    return read
+
+
+def _filereader(fp):
+    def read(offset, size):
+        fp.seek(offset)
+        return fp.read(size)
+
+    return read
+
+
+def _reader(src):
+    if isinstance(src, (bytes, bytearray, memoryview, mmap.mmap)):
+        return _bufferreader(src)
+    return _filereader(src)
+
+
+def _open(src, func):
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as fp:
+            return func(_filereader(fp))
+    return func(_reader(src))
+
+
+def find_exif(src):
+    '''
+    Walk the JPEG marker segments up to the APP1 Exif segment.
+
+    `src` may be a path, a binary file object or a buffer (bytes, bytearray,
+    memoryview or mmap). The scan data is never read. Returns the offset of
+    the segment payload in `src` and the payload itself, which is a
+    memoryview into `src` for buffers.
+    '''
+    return _open(src, _find_exif)
+
+
+def jpegsize(src):
+    '''
+    Return the (width, height) of a JPEG image from its SOF marker.
+
+    `src` is the same as in `find_exif`. The image is not decoded.
+    '''
+    return _open(src, _jpegsize)
+
+
+def _segments(read):
+    '''
+    Yield (marker, offset, length) of the marker segments before the scan.
+
+    `offset` is the position of the marker and `length` is the segment
+    length field, which includes itself. The walk ends with the SOS or EOI
+    marker, whose length is None.
+    '''
+    if bytes(read(0, 2)) != b'\xff\xd8':
+        raise ValueError('Not a JPEG file.')
+
+    pos = 2
+    while True:
+        segment = read(pos, 4)
+        if len(segment) < 2 or segment[0] != 0xff:
+            raise ValueError('Invalid JPEG marker.')
+        marker = segment[1]
+        if marker == 0xff:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in (0xd9, 0xda):
+            # EOI or SOS: no more metadata segments
+            yield marker, pos, None
+            return
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            # Standalone marker
+            pos += 2
+            continue
+        if len(segment) < 4:
+            raise ValueError('Invalid JPEG marker.')
+
+        length = segment[2] << 8 | segment[3]
+        if length < 2:
+            raise ValueError('Invalid JPEG marker.')
+        yield marker, pos, length
+        pos += 2 + length
+
+
+def _find_exif(read):
+    code = ExifReader.EXIF_ID_CODE
+    for marker, pos, length in _segments(read):
+        if marker == 0xe1:
+            payload = read(pos + 4, length - 2)
+            if payload[:len(code)] == code:
+                return pos + 4, payload
+
+    raise ValueError('No EXIF.')
+
+
+# Bytes copied at once by splice
+SPLICE_CHUNK = 1 << 20
+
+SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def _jpegsize(read):
+    for marker, pos, length in _segments(read):
+        if marker in SOF_MARKERS:
+            frame = read(pos + 4, 5)
+            if len(frame) < 5:
+                raise ValueError('Invalid JPEG marker.')
+            _, height, width = struct.unpack('>BHH', frame)
+            return width, height
+
+    raise ValueError('No SOF marker.')
+
+
+def splice(src, dst, exif):
+    '''
+    Copy the JPEG file `src` to `dst` with the APP1 Exif segment replaced.
+
+    `exif` is a payload starting with ``Exif\\x00\\x00`` such as
+    `ExifReader.tobytes()`. If `src` has no Exif segment, it is inserted
+    after the JFIF segment. The other segments and the scan data are copied
+    as they are in chunks. `dst` is replaced atomically, so it may be `src`.
+    '''
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as fp:
+            return splice(fp, dst, exif)
+
+    code = ExifReader.EXIF_ID_CODE
+    if exif[:len(code)] != code:
+        raise ValueError('No EXIF.')
+    if len(exif) + 2 > 0xffff:
+        raise ValueError('EXIF is too large: {} bytes.'.format(len(exif)))
+    app1 = struct.pack('>HH', 0xffe1, len(exif) + 2) + exif
+
+    read = _filereader(src)
+    segments = list(_segments(read))
+    exifs = [
+        pos for marker, pos, length in segments
+        if marker == 0xe1 and read(pos + 4, len(code)) == code
+    ]
+
+    if exifs:
+        at = exifs[0]
+    else:
+        at = next(pos for marker, pos, _ in segments if marker != 0xe0)
+
+    fd, tmp = tempfile.mkstemp(suffix='.jpg',
+                               dir=os.path.dirname(os.path.abspath(dst)))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(b'\xff\xd8')
+            for marker, pos, length in segments:
+                if pos == at:
+                    fp.write(app1)
+                if length is None:
+                    break
+                if pos not in exifs:
+                    fp.write(read(pos, 2 + length))
+
+            # Scan data up to the end of the file
+            src.seek(pos)
+            shutil.copyfileobj(src, fp, SPLICE_CHUNK)
+        try:
+            # mkstemp creates the file private to the user
+            os.chmod(tmp, stat.S_IMODE(os.fstat(src.fileno()).st_mode))
+        except (AttributeError, OSError):
+            pass
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 class ExifReader(object):
-    """EXIF reader class for THETA image."""
+    """EXIF reader class for THETA image.
+
+    `img` may be a Pillow image, a path, a binary file object or a buffer.
+    Except for Pillow images, only the JPEG header is read and Pillow is
+    used lazily when `img` is accessed. Buffers are not copied; writes are
+    applied to a private copy, or to the buffer itself if `inplace` is True.
+    """
 
     EXIF_ID_CODE = b'Exif\x00\x00'
     RICOH_MAKERNOTE_CODE = b'Ricoh\x00\x00\x00'
 
-    def __init__(self, img):
-        if not isinstance(img, Image.Image):
-            img = Image.open(img)
-        if 'exif' not in img.info:
-            raise ValueError('No EXIF.')
+    def __init__(self, img, inplace=False):
+        if _isimage(img):
+            if 'exif' not in img.info:
+                raise ValueError('No EXIF.')
+            self._img = img
+            self._src = None
+            exif = img.info['exif']
+            # Offset of the TIFF header in the source file
+            self.offset = None
+        else:
+            self._img = None
+            self._src = img
+            offset, exif = find_exif(img)
+            self.offset = offset + len(ExifReader.EXIF_ID_CODE)
 
-        self.img = img
-        body = img.info['exif'][len(ExifReader.EXIF_ID_CODE):]
-        self.fp = io.BytesIO(body)
-        header = TIFFHeader(self.fp)
+        body = memoryview(exif)[len(ExifReader.EXIF_ID_CODE):]
+        self.buffer = Buffer(body, inplace)
+        header = TIFFHeader(self.buffer)
 
         self.ifdlist = []
-        while True:
-            ifd = TagReader(self.fp, header)
+        offsets = set()
+        offset = header.zeroth_ifd_offset
+        while offset:
+            if offset in offsets:
+                raise ValueError('Circular IFD chain.')
+            offsets.add(offset)
+            ifd = TagReader(self.buffer, offset, header)
             self.ifdlist.append(ifd)
-            if ifd.nextifd_offset:
-                self.fp.seek(ifd.nextifd_offset)
-            else:
-                break
+            offset = ifd.nextifd_offset
+        if not self.ifdlist:
+            raise ValueError('No IFD.')
 
         self._makernote = None
 
+    @property
+    def img(self):
+        if self._img is None:
+            from PIL import Image
+
+            src = self._src
+            if isinstance(src, (bytes, bytearray, memoryview, mmap.mmap)):
+                src = io.BytesIO(src)
+            self._img = Image.open(src)
+        return self._img
+
     @property
     def exif(self):
         return self.ifdlist[0][tag.EXIF_IFD_POINTER]
@@ -238,16 +558,17 @@ class ExifReader(object):
 
     @property
     def makernote(self):
-        if not self._makernote:
+        if self._makernote is None:
             if tag.MAKER_NOTE not in self.exif:
                 raise ValueError('No MakerNote.')
 
-            self.fp.seek(self.exif.getoffset(tag.MAKER_NOTE))
-            code_len = len(ExifReader.RICOH_MAKERNOTE_CODE)
-            if self.fp.read(code_len) != self.RICOH_MAKERNOTE_CODE:
+            offset = self.exif.getoffset(tag.MAKER_NOTE)
+            code = self.RICOH_MAKERNOTE_CODE
+            if self.buffer.view[offset:offset + len(code)] != code:
                 raise ValueError('No RICOH maker note.')
 
-            self._makernote = TagReader(self.fp, self.exif.header)
+            self._makernote = TagReader(self.buffer, offset + len(code),
+                                        self.exif.header)
         return self._makernote
 
     @property
@@ -257,22 +578,127 @@ class ExifReader(object):
         return self.makernote[tag.THETA_SUBDIR]
 
     @property
-    def thumbnail(self):
+    def thumbnaildata(self):
+        '''
+        Embedded thumbnail JPEG as a zero-copy memoryview.
+        '''
+        if len(self.ifdlist) < 2:
+            raise ValueError('No thumbnail.')
         offset = self.ifdlist[1][tag.JPEG_INTERCHANGE_FORMAT]
         length = self.ifdlist[1][tag.JPEG_INTERCHANGE_FORMAT_LENGTH]
-        self.fp.seek(offset)
-        fp = io.BytesIO(self.fp.read(length))
-        return Image.open(fp)
+        if not isinstance(offset, int) or not isinstance(length, int):
+            raise ValueError('Invalid thumbnail offset.')
+        if offset + length > len(self.buffer):
+            raise ValueError('Offset out of range.')
+        return self.buffer.view[offset:offset + length]
+
+    @property
+    def thumbnailsize(self):
+        '''
+        Size of the embedded thumbnail, read without decoding it.
+        '''
+        return jpegsize(self.thumbnaildata)
+
+    @property
+    def thumbnail(self):
+        from PIL import Image
+
+        return Image.open(io.BytesIO(self.thumbnaildata))
 
     @thumbnail.setter
     def thumbnail(self, img):
         offset = self.ifdlist[1][tag.JPEG_INTERCHANGE_FORMAT]
-        self.fp.seek(offset)
-        img.save(self.fp, 'JPEG')
-        end = self.fp.tell()
-        self.fp.truncate()
-        self.ifdlist[1][tag.JPEG_INTERCHANGE_FORMAT_LENGTH] = end - offset
+        fp = io.BytesIO()
+        img.save(fp, 'JPEG')
+        self.buffer.replace(offset, fp.getbuffer())
+        self.ifdlist[1][tag.JPEG_INTERCHANGE_FORMAT_LENGTH] = fp.tell()
 
     def tobytes(self):
-        self.fp.seek(0)
-        return self.EXIF_ID_CODE + self.fp.read()
+        return self.EXIF_ID_CODE + self.buffer.view.tobytes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        '''
+        Release the source buffer, e.g. before closing an mmap.
+        '''
+        self.buffer.release()
+
+
+def _plain(value):
+    if isinstance(value, fractions.Fraction):
+        return float(value)
+    elif isinstance(value, bytes):
+        try:
+            return value.rstrip(b'\x00').decode('ascii')
+        except UnicodeDecodeError:
+            return value.hex()
+    elif isinstance(value, tuple):
+        return [_plain(v) for v in value]
+    return value
+
+
+def metadata(reader):
+    '''
+    Return the MakerNote and THETA subdir tags as plain Python values.
+
+    Tags are keyed by name, or by hex id if unknown. Rationals become
+    floats, strings become str and arrays become lists.
+    '''
+    result = {}
+    for name, ifd, names in (('makernote', reader.makernote,
+                              tag.MARKERNOTE_TAGS),
+                             ('theta', reader.theta, tag.THETASUBDIR_TGAS)):
+        values = {}
+        for k, v in ifd.items():
+            if isinstance(v, TagReader):
+                continue
+            values[names.get(k, '0x{:04x}'.format(k))] = _plain(v)
+        result[name] = values
+    return result
+
+
+def patch(path, zenith=None, compass=None, thumbnail=False):
+    '''
+    Overwrite THETA pose tags of a JPEG file in place.
+
+    The file is memory-mapped and only the bytes of ZENITH_ES, COMPASS_ES and
+    GPS_IMG_DIRECTION are rewritten. The image is neither decoded nor copied.
+
+    If `thumbnail` is True, the thumbnail is regenerated from a reduced
+    decoding of the image and the Exif segment is spliced into the file.
+    The scan data is copied as it is.
+    '''
+    if thumbnail:
+        from PIL import Image
+
+        reader = ExifReader(path)
+        size = reader.thumbnailsize
+        with Image.open(path) as img:
+            img.draft(img.mode, size)
+            reader.thumbnail = img.resize(size, Image.BOX, reducing_gap=2.0)
+        splice(path, path, reader.tobytes())
+
+    if zenith is None and compass is None:
+        return
+    with open(path, 'r+b') as fp, mmap.mmap(fp.fileno(), 0) as mm:
+        with ExifReader(mm, inplace=True) as reader:
+            updates = []
+            if zenith is not None:
+                updates.append((reader.theta, tag.ZENITH_ES, zenith))
+            if compass is not None:
+                updates.append((reader.theta, tag.COMPASS_ES, compass))
+                if tag.GPS_INFO_IFD_POINTER in reader.ifdlist[0]:
+                    updates.append(
+                        (reader.gps, tag.GPS_IMG_DIRECTION, compass))
+
+            # Writes go straight to the file, so check every value first
+            for ifd, key, value in updates:
+                ifd.encode(key, value)
+            for ifd, key, value in updates:
+                ifd[key] = value
+            mm.flush()
@@ -0,0 +1,155 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+
+from PIL import Image
+
+from . import projection
+from .stats import Stats, stager
+
+
+class Pipeline(object):
+    '''
+    Run items through stages, each on its own thread.
+
+    At most `inflight` items are between submission and completion, so
+    `submit` blocks until an earlier item leaves the pipeline.
+    '''
+    def __init__(self, stages, inflight=3):
+        self._slots = threading.BoundedSemaphore(inflight)
+        self._queues = [queue.Queue() for _ in stages] + [None]
+        self._threads = []
+        for i, stage in enumerate(stages):
+            thread = threading.Thread(target=self._run,
+                                      args=(stage, self._queues[i],
+                                            self._queues[i + 1]),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, item):
+        '''
+        Feed `item` to the first stage and return a future of the result.
+        '''
+        self._slots.acquire()
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        self._queues[0].put((future, item))
+        return future
+
+    def shutdown(self):
+        self._queues[0].put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, stage, inq, outq):
+        while True:
+            task = inq.get()
+            if task is None:
+                if outq is not None:
+                    outq.put(None)
+                return
+
+            future, item = task
+            try:
+                item = stage(item)
+            except Exception as e:
+                self._slots.release()
+                future.set_exception(e)
+                continue
+
+            if outq is not None:
+                outq.put((future, item))
+            else:
+                self._slots.release()
+                future.set_result(item)
+
+
+def rectifier(compass=False,
+              exif=False,
+              cache=None,
+              backend=None,
+              memory=None,
+              threads=None,
+              inflight=3,
+              thumbnail='grid',
+              scale=None,
+              output_size=None,
+              stats=False,
+              maptype='float32'):
+    '''
+    Return a pipeline rectifying (src, dst) pairs.
+
+    Decoding, remapping and encoding run on separate threads, so the next
+    image is decoded while the current one is remapped and the previous one
+    is encoded. If `stats` is True, the result of each image is its
+    `stats.Stats`, otherwise None.
+    '''
+    def decode(job):
+        src, dst = job
+        record = Stats() if stats else None
+        with stager(record)('decode'):
+            img = Image.open(src)
+            # The output size depends on the size before DCT scaling
+            size = projection.targetsize(img.size, scale, output_size)
+            img = projection.decode(img, size)
+        return img, size, dst, record
+
+    def compute(job):
+        img, size, dst, record = job
+        rectified = projection.rectify(img,
+                                       compass,
+                                       cache=cache,
+                                       backend=backend,
+                                       memory=memory,
+                                       threads=threads,
+                                       thumbnail=thumbnail,
+                                       output_size=size,
+                                       stats=record,
+                                       maptype=maptype)
+        return rectified, dst, record
+
+    def encode(job):
+        rectified, dst, record = job
+        projection.save(rectified, dst, exif, record)
+        return record
+
+    return Pipeline([decode, compute, encode], inflight)
+
+
+def rectify_files(jobs,
+                  compass=False,
+                  exif=False,
+                  cache=None,
+                  backend=None,
+                  memory=None,
+                  threads=None,
+                  inflight=3,
+                  thumbnail='grid',
+                  scale=None,
+                  output_size=None,
+                  maptype='float32'):
+    '''
+    Rectify (src, dst) pairs through `rectifier`.
+
+    Yields (src, dst, error) in input order, where error is None on success.
+    '''
+    with rectifier(compass, exif, cache, backend, memory, threads, inflight,
+                   thumbnail, scale, output_size,
+                   maptype=maptype) as pipeline:
+        futures = collections.deque()
+        for src, dst in jobs:
+            futures.append((src, dst, pipeline.submit((src, dst))))
+            while futures and futures[0][2].done():
+                src, dst, future = futures.popleft()
+                yield src, dst, future.exception()
+        while futures:
+            src, dst, future = futures.popleft()
+            yield src, dst, future.exception()
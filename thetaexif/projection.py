@@ -1,38 +1,488 @@
+import collections
+import concurrent.futures
+import contextlib
 import functools
+import hashlib
+import os
+import tempfile
+import threading
 
 import numpy as np
 from PIL import Image
 
 from . import tag
+from .constants import MAP_TYPES, THUMBNAIL_METHODS
 from .exif import ExifReader
+from .stats import stager
 
+REMAP_BLOCK_PIXELS = 1 << 14
+# Output pixels whose coordinates are computed at once in float64
+COORDINATE_BLOCK_PIXELS = 1 << 16
+# Fractional bits of each coordinate of fixed-point maps
+FIXED_BITS = 8
+# Poses tilted by less than this fraction of a pixel are shifted about the
+# vertical axis instead of remapped
+YAW_TOLERANCE = 0.25
+# Shifts closer than this to an integer are not interpolated
+SHIFT_TOLERANCE = 1e-6
+# Cube faces and the yaw and pitch of their centers in degrees
+CUBE_FACES = collections.OrderedDict([('front', (0, 0)), ('right', (90, 0)),
+                                      ('back', (180, 0)), ('left', (-90, 0)),
+                                      ('up', (0, 90)), ('down', (0, -90))])
 
-def getcoordinates(w, h, r):
-    uu, vv = np.meshgrid(np.arange(w), np.arange(h))
-    t = (uu - w / 2) * 2 * np.pi / w
-    p = (vv - h / 2) * np.pi / h
+
+def _getcoordinates_numpy(w, h, r, start, stop, dtype=np.float64):
+    # The direction of pixel (u, v) is (cos(p) sin(t), sin(p), cos(p) cos(t)),
+    # so the rotated direction is the outer product of per-row and per-column
+    # terms plus a per-row offset. Only the inverse functions run on h x w,
+    # in blocks of rows so that the float64 temporaries stay small.
+    t = (np.arange(w) - w / 2) * 2 * np.pi / w
+    p = (np.arange(start, stop) - h / 2) * np.pi / h
     st, ct = np.sin(t), np.cos(t)
     sp, cp = np.sin(p), np.cos(p)
-    xyz = np.dstack((cp * st, sp, cp * ct))
-    xyz = np.einsum('ij,...j', r, xyz)
-    t = np.arctan2(xyz[:, :, 0], xyz[:, :, 2])
-    p = np.arcsin(xyz[:, :, 1])
-    uu = t * w / 2 / np.pi + w / 2
-    vv = p * h / np.pi + h / 2
-    return np.dstack((vv, uu)).transpose(2, 0, 1)
+    cols = r[:, 0, None] * st + r[:, 2, None] * ct
+    rows = r[:, 1, None] * sp
+
+    coord = np.empty((2, stop - start, w), dtype)
+    block = max(1, COORDINATE_BLOCK_PIXELS // w)
+    for i in range(0, stop - start, block):
+        j = min(i + block, stop - start)
+        x = np.multiply.outer(cp[i:j], cols[0])
+        x += rows[0, i:j, None]
+        z = np.multiply.outer(cp[i:j], cols[2])
+        z += rows[2, i:j, None]
+        uu = np.arctan2(x, z, out=x)
+        uu *= w / 2 / np.pi
+        uu += w / 2
+        coord[1, i:j] = uu
+
+        y = np.multiply.outer(cp[i:j], cols[1], out=z)
+        y += rows[1, i:j, None]
+        np.clip(y, -1, 1, out=y)
+        vv = np.arcsin(y, out=y)
+        vv *= h / np.pi
+        vv += h / 2
+        coord[0, i:j] = vv
+    return coord
+
+
+def _backends():
+    backends = collections.OrderedDict()
+    backends['numpy'] = _getcoordinates_numpy
+    try:
+        from . import _mapping
+    except ImportError:
+        pass
+    else:
+        backends['compiled'] = _mapping.getcoordinates
+        # The compiled backend is parallel but slower on a single core
+        if (os.cpu_count() or 1) > 1:
+            backends.move_to_end('compiled', last=False)
+    return backends
+
+
+# Available coordinate backends, fastest first
+BACKENDS = _backends()
+
+
+def _backendname(name=None):
+    if name is None:
+        name = os.environ.get('THETAEXIF_BACKEND') or next(iter(BACKENDS))
+    if name not in BACKENDS:
+        raise ValueError('Unavailable backend: {} (choose from {})'.format(
+            name, ', '.join(BACKENDS)))
+    return name
+
+
+def getbackend(name=None):
+    '''
+    Return the coordinate backend `name`.
+
+    If `name` is None, $THETAEXIF_BACKEND or the fastest available backend is
+    used.
+    '''
+    return BACKENDS[_backendname(name)]
+
+
+def _checkmaptype(maptype):
+    if maptype not in MAP_TYPES:
+        raise ValueError('Unknown map type: {} (choose from {})'.format(
+            maptype, ', '.join(MAP_TYPES)))
+
+
+def getcoordinates(w,
+                   h,
+                   r,
+                   backend=None,
+                   start=0,
+                   stop=None,
+                   maptype='float64'):
+    '''
+    Return source coordinates of rows `start` to `stop` of a w x h image.
+
+    The map is a (2, rows, w) array of (v, u) of `maptype` 'float64' or
+    'float32', or a fixed-point map of `tofixed` if `maptype` is 'fixed'.
+    '''
+    if stop is None:
+        stop = h
+    func = getbackend(backend)
+    r = np.ascontiguousarray(r, np.float64)
+    return _buildmap(lambda i, j, dtype: func(w, h, r, i, j, dtype), w, start,
+                     stop, maptype)
+
+
+def _tiledcoordinates(w, h, r, backend, maptype, threads):
+    if threads == 1:
+        return getcoordinates(w, h, r, backend, maptype=maptype)
+
+    # Tiles are written into one map, so no whole-size copy is made
+    if maptype == 'fixed':
+        coord = np.empty((3, h, w), np.int16)
+    else:
+        coord = np.empty((2, h, w), maptype)
+    rows = -(-h // (4 * threads))
+
+    def work(start):
+        stop = min(start + rows, h)
+        coord[:, start:stop] = getcoordinates(w, h, r, backend, start, stop,
+                                              maptype)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        list(executor.map(work, range(0, h, rows)))
+    return coord
+
+
+def _buildmap(generate, w, start, stop, maptype):
+    # generate(start, stop, dtype) returns a float map of the rows
+    _checkmaptype(maptype)
+    if maptype != 'fixed':
+        return generate(start, stop, np.dtype(maptype))
+
+    # Convert in blocks so that no float map of the whole size is allocated
+    coord = np.empty((3, stop - start, w), np.int16)
+    block = max(1, COORDINATE_BLOCK_PIXELS // w)
+    for i in range(start, stop, block):
+        j = min(i + block, stop)
+        tofixed(generate(i, j, np.dtype(np.float32)),
+                coord[:, i - start:j - start])
+    return coord
+
+
+def isfixed(coord):
+    '''
+    Return True if `coord` is a fixed-point map.
+    '''
+    return coord.dtype == np.int16
+
+
+def tofixed(coord, out=None):
+    '''
+    Convert a float map to fixed point.
+
+    The result is a (3, h, w) int16 array of the integer parts of v and u and
+    their `FIXED_BITS` fractions packed into one uint16, fraction of v in the
+    high byte. Coordinates are rounded to 1/256 pixel and must be in the
+    int16 range, which covers sources up to 32767 pixels wide; ValueError is
+    raised otherwise.
+    '''
+    h, w = coord.shape[1:]
+    one = 1 << FIXED_BITS
+    if coord.size and (coord.min() < -(1 << 15)
+                       or coord.max() >= (1 << 15) - 0.5 / one):
+        raise ValueError('Coordinates exceed the fixed-point range; '
+                         'sources must be narrower than 32768 pixels.')
+    if out is None:
+        out = np.empty((3, h, w), np.int16)
+    scaled = np.rint(coord * np.float32(one)).astype(np.int32)
+    np.right_shift(scaled, FIXED_BITS, out=out[:2], casting='unsafe')
+    scaled &= one - 1
+    frac = out[2].view(np.uint16)
+    np.left_shift(scaled[0], FIXED_BITS, out=frac, casting='unsafe')
+    frac |= scaled[1].astype(np.uint16)
+    return out
+
+
+def fromfixed(coord, dtype=np.float32):
+    '''
+    Convert a fixed-point map back to a float map.
+    '''
+    integer, fv, fu = _splitfixed(coord, dtype)
+    out = integer.astype(dtype)
+    out[0] += fv
+    out[1] += fu
+    return out
 
 
-def remap(imgarray, coordinates):
-    from scipy import ndimage
-    remapped = np.empty_like(imgarray)
-    for c in range(imgarray.shape[2]):
-        ndimage.map_coordinates(imgarray[..., c],
-                                coordinates,
-                                order=1,
-                                mode='wrap',
-                                output=remapped[..., c])
+def _splitfixed(coord, dtype=np.float32):
+    frac = coord[2].view(np.uint16)
+    scale = np.dtype(dtype).type(1 / (1 << FIXED_BITS))
+    fv = (frac >> FIXED_BITS).astype(dtype)
+    fv *= scale
+    fu = (frac & ((1 << FIXED_BITS) - 1)).astype(dtype)
+    fu *= scale
+    return coord[:2], fv, fu
 
-    return remapped
+
+class CoordinateCache(object):
+    '''
+    LRU cache of coordinate grids bounded by bytes.
+
+    Grids are keyed by the image size, the rotation matrix quantized by
+    `tolerance`, the view and the backend, and stored as `maptype`. If
+    `directory` is given, grids are also saved there as .npy files, which
+    are memory-mapped when they are loaded again. The files are bounded by
+    `maxdiskbytes`, evicting the least recently used ones.
+    '''
+
+    def __init__(self,
+                 maxbytes=1 << 30,
+                 tolerance=1e-5,
+                 directory=None,
+                 backend=None,
+                 maptype='float32',
+                 maxdiskbytes=4 << 30):
+        _checkmaptype(maptype)
+        self.maxbytes = maxbytes
+        self.maxdiskbytes = maxdiskbytes
+        self.tolerance = tolerance
+        self.directory = directory
+        self.backend = backend
+        self.maptype = maptype
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, w, h, r, view=None):
+        q = np.round(np.asarray(r, np.float64) / self.tolerance)
+        # Backends differ in precision, so their grids are not shared
+        key = (w, h) + tuple(q.astype(np.int64).ravel().tolist()) + (
+            _backendname(self.backend), self.maptype)
+        if view is not None:
+            key += view.key()
+        return key
+
+    def fits(self, w, h):
+        '''
+        Return whether a w x h grid can be kept in memory or on disk.
+        '''
+        nbytes = MAP_TYPES[self.maptype] * w * h
+        return nbytes <= self.maxbytes or (self.directory is not None
+                                           and nbytes <= self.maxdiskbytes)
+
+    def get(self, w, h, r, view=None, threads=None):
+        '''
+        Return the coordinates of `view` in a w x h source rotated by `r`.
+
+        If `view` is None, it is the equirectangular image of the source
+        size, and a missing grid is generated in row tiles on `threads`
+        threads.
+        '''
+        key = self.key(w, h, r, view)
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                pass
+
+        coord = self._load(key)
+        if coord is None:
+            if view is None:
+                coord = _tiledcoordinates(w, h, r, self.backend,
+                                          self.maptype, threads or 1)
+            else:
+                coord = view.coordinates(w, h, r, self.backend,
+                                         maptype=self.maptype)
+            coord.flags.writeable = False
+            self._save(key, coord)
+        self._put(key, coord)
+        return coord
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _put(self, key, coord):
+        if coord.nbytes > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = coord
+            self.nbytes += coord.nbytes
+            while self.nbytes > self.maxbytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory,
+                            '{}x{}-{}.npy'.format(key[0], key[1], digest))
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            coord = np.load(path, mmap_mode='r')
+            # The mtime orders files for eviction, as atime is often not
+            # updated
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return coord
+
+    def _save(self, key, coord):
+        if self.directory is None or coord.nbytes > self.maxdiskbytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.save(fp, coord)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._evict()
+
+    def _evict(self):
+        # Other processes may share the directory and remove files as well
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npy'):
+                continue
+            with contextlib.suppress(OSError):
+                st = entry.stat()
+                files.append((st.st_mtime_ns, st.st_size, entry.path))
+        nbytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if nbytes <= self.maxdiskbytes:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            nbytes -= size
+
+
+def remap(imgarray, coordinates, output=None):
+    # Bilinear sampling of all channels at once. Longitude wraps around and
+    # latitude is clamped at the poles. Rows are processed in small blocks so
+    # that the temporaries stay in cache. Fixed-point maps are split into
+    # their integer and fractional parts directly.
+    sh, sw = imgarray.shape[:2]
+    h, w = coordinates.shape[1:]
+    if output is None:
+        output = np.empty((h, w) + imgarray.shape[2:], imgarray.dtype)
+    elif not output.flags.c_contiguous:
+        # Reshaping would copy and the result would be lost
+        raise ValueError('output must be C-contiguous')
+    src = imgarray.reshape(sh * sw, -1)
+    dst = output.reshape(h, w, -1)
+    rounding = 0.5 if np.issubdtype(output.dtype, np.integer) else 0
+
+    fixed = isfixed(coordinates)
+    block = max(1, REMAP_BLOCK_PIXELS // w)
+    for start in range(0, h, block):
+        if fixed:
+            integer, fv, fu = _splitfixed(coordinates[:, start:start + block])
+            v0, u0 = integer
+            fv = fv[..., None]
+            fu = fu[..., None]
+        else:
+            vv = coordinates[0, start:start + block]
+            uu = coordinates[1, start:start + block]
+            v0 = np.floor(vv)
+            u0 = np.floor(uu)
+            fv = (vv - v0).astype(np.float32)[..., None]
+            fu = (uu - u0).astype(np.float32)[..., None]
+
+        v0 = v0.astype(np.intp)
+        v1 = np.clip(v0 + 1, 0, sh - 1)
+        v1 *= sw
+        np.clip(v0, 0, sh - 1, out=v0)
+        v0 *= sw
+        u0 = u0.astype(np.intp)
+        u0 %= sw
+        u1 = u0 + 1
+        u1[u1 == sw] = 0
+
+        p00 = np.take(src, v0 + u0, axis=0).astype(np.float32)
+        p01 = np.take(src, v0 + u1, axis=0).astype(np.float32)
+        p10 = np.take(src, v1 + u0, axis=0).astype(np.float32)
+        p11 = np.take(src, v1 + u1, axis=0).astype(np.float32)
+        p01 -= p00
+        p01 *= fu
+        p00 += p01
+        p11 -= p10
+        p11 *= fu
+        p10 += p11
+        p10 -= p00
+        p10 *= fv
+        p00 += p10
+        p00 += rounding
+        dst[start:start + block] = p00
+
+    return output
+
+
+def yawshift(r, w):
+    '''
+    Return the column shift of the inverse rotation `r` for a w pixels wide
+    image, or None if `r` is not a rotation about the vertical axis up to
+    `YAW_TOLERANCE` pixels.
+    '''
+    # A tilt by a small angle moves pixels by up to that angle, and a pixel
+    # spans 2 pi / w radians
+    tolerance = YAW_TOLERANCE * 2 * np.pi / w
+    if (np.abs(r[1] - (0, 1, 0)).max() > tolerance
+            or np.abs(r[:, 1] - (0, 1, 0)).max() > tolerance):
+        return None
+    # The source longitude is the destination longitude plus the yaw angle
+    return np.arctan2(r[0, 2], r[0, 0]) * w / 2 / np.pi
+
+
+def shift(imgarray, columns, output=None):
+    '''
+    Rotate an equirectangular image by `columns` pixels about the vertical
+    axis, i.e. output[:, u] = imgarray[:, u + columns].
+
+    Integer shifts are exact column rolls. Otherwise each row is linearly
+    interpolated with the same weights as `remap`.
+    '''
+    h, w = imgarray.shape[:2]
+    if output is None:
+        output = np.empty_like(imgarray)
+    k = int(np.floor(columns))
+    f = columns - k
+    if f > 1 - SHIFT_TOLERANCE:
+        k, f = k + 1, 0
+    k %= w
+
+    if f < SHIFT_TOLERANCE:
+        # np.roll without the temporary
+        output[:, :w - k] = imgarray[:, k:]
+        output[:, w - k:] = imgarray[:, :k]
+        return output
+
+    u0 = np.roll(np.arange(w), -k)
+    u1 = np.roll(u0, -1)
+    fu = np.float32(f)
+    rounding = 0.5 if np.issubdtype(output.dtype, np.integer) else 0
+    block = max(1, REMAP_BLOCK_PIXELS // w)
+    for start in range(0, h, block):
+        rows = imgarray[start:start + block]
+        p0 = np.take(rows, u0, axis=1).astype(np.float32)
+        p1 = np.take(rows, u1, axis=1).astype(np.float32)
+        p1 -= p0
+        p1 *= fu
+        p0 += p1
+        p0 += rounding
+        output[start:start + block] = p0
+    return output
 
 
 def rotation(axis, angle):
@@ -63,33 +513,434 @@ def getpose(reader, compass=False):
     return r
 
 
-def rectify(img, compass=False):
+def scalecoordinates(coord, w, h, sw, sh, out=None):
+    '''
+    Scale coordinates generated for a w x h image to a sw x sh source.
+
+    Pixel centers are aligned, so a grid at a small size can sample a
+    larger or smaller copy of the source. Fixed-point maps are scaled to a
+    new float32 map.
+    '''
+    if isfixed(coord):
+        coord = fromfixed(coord)
+    scale = np.array([sh / h, sw / w], coord.dtype)[:, None, None]
+    out = np.add(coord, np.array(0.5, coord.dtype), out=out)
+    out *= scale
+    out -= 0.5
+    return out
+
+
+def targetsize(size, scale=None, output_size=None):
+    '''
+    Return the output size for a source of `size` given `scale` or
+    `output_size`.
+    '''
+    if output_size is not None:
+        if scale is not None:
+            raise ValueError('scale and output_size are exclusive.')
+        w, h = output_size
+    elif scale is not None:
+        w, h = (round(n * scale) for n in size)
+    else:
+        w, h = size
+    if w < 1 or h < 1:
+        raise ValueError('Invalid output size: {}x{}'.format(w, h))
+    return w, h
+
+
+def decode(img, size=None):
+    '''
+    Open and decode `img`.
+
+    If `size` is given, JPEG images are decoded with DCT scaling to the
+    smallest power of two reduction that is at least `size`. It has no
+    effect on images which are already decoded.
+    '''
     if not isinstance(img, Image.Image):
         img = Image.open(img)
+    if size is not None:
+        img.draft(img.mode, size)
+    img.load()
+    return img
 
-    reader = ExifReader(img)
-    r = getpose(reader, compass).T
 
-    imgarray = np.asarray(img)
-    h, w = imgarray.shape[:2]
+def _thumbnail(img, resultimg, size, r, method, cache, backend):
+    tw, th = size
+    w, h = img.size
+    if method == 'grid':
+        # Sample a box-filtered copy of the source at twice the thumbnail size
+        factor = max(1, min(w // (2 * tw), h // (2 * th)))
+        small = np.asarray(img.reduce(factor) if factor > 1 else img)
+        if cache is not None:
+            coord = cache.get(tw, th, r)
+        else:
+            coord = getcoordinates(tw, th, r, backend)
+        sh, sw = small.shape[:2]
+        coord = scalecoordinates(coord, tw, th, sw, sh)
+        return Image.fromarray(remap(small, coord))
+    else:
+        return resultimg.resize(size, Image.BOX, reducing_gap=2.0)
+
+
+def _rotate(imgarray, r, size, cache, backend, maptype, memory, threads,
+            stage):
+    sh, sw = imgarray.shape[:2]
+    w, h = size
+    scaled = (w, h) != (sw, sh)
+    if scaled and maptype == 'fixed':
+        # Bands are scaled in place, which needs a float map
+        maptype = 'float32'
+    threads = threads or 1
+    if memory is not None:
+        rows = max(1, memory // (MAP_TYPES[maptype] * w * threads))
+    elif threads > 1:
+        rows = -(-h // (4 * threads))
+    else:
+        rows = h
+
+    coord = None
+    if memory is None and cache is not None and cache.fits(w, h):
+        with stage('coordinates'):
+            coord = cache.get(w, h, r, threads=threads)
+
+    rectified = np.empty((h, w) + imgarray.shape[2:], imgarray.dtype)
+
+    def work(start):
+        stop = min(start + rows, h)
+        if coord is None:
+            with stage('coordinates'):
+                band = getcoordinates(w, h, r, backend, start, stop,
+                                      maptype)
+                if scaled:
+                    scalecoordinates(band, w, h, sw, sh, band)
+        elif scaled:
+            with stage('coordinates'):
+                band = scalecoordinates(coord[:, start:stop], w, h, sw, sh)
+        else:
+            band = coord[:, start:stop]
+        with stage('remap'):
+            remap(imgarray, band, rectified[start:stop])
+
+    if threads > 1:
+        # NumPy releases the GIL in the heavy loops
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            list(executor.map(work, range(0, h, rows)))
+    else:
+        for start in range(0, h, rows):
+            work(start)
+
+    return rectified
+
+
+def rectify(img,
+            compass=False,
+            cache=None,
+            backend=None,
+            memory=None,
+            threads=None,
+            thumbnail='grid',
+            scale=None,
+            output_size=None,
+            stats=None,
+            maptype='float32'):
+    '''
+    Rotate a THETA image to cancel the camera pose.
+
+    The result is `scale` times the source size or `output_size` (w, h).
+    JPEG files are then decoded at a reduced size by the DCT and coordinates
+    are generated only at the output size. Pass a path or an image which is
+    not loaded yet to benefit from the reduced decoding.
+
+    Coordinates are generated as `maptype` (see `MAP_TYPES`), unless they
+    come from `cache`, which has its own map type.
+
+    If `memory` is given, coordinates are generated and remapped in
+    horizontal bands so that the coordinates stay within `memory` bytes.
+    The cache is not used in that case, nor if the grid does not fit in it.
+
+    If `threads` is given, row tiles are processed on that many threads,
+    including the generation of a grid missing from the cache. The result
+    is identical to the single-threaded one.
+
+    If the pose is a pure yaw, e.g. a level image rectified with the
+    compass, columns are shifted by `shift` instead.
+
+    The EXIF thumbnail is regenerated by `thumbnail`: 'grid' remaps a
+    reduced source with a grid at the thumbnail size, and 'reduce'
+    area-averages the rectified image.
+
+    If a `stats.Stats` is given, the stages are recorded in it.
+    '''
+    if thumbnail not in THUMBNAIL_METHODS:
+        raise ValueError(
+            'Unknown thumbnail method: {} (choose from {})'.format(
+                thumbnail, ', '.join(THUMBNAIL_METHODS)))
+    _checkmaptype(maptype)
+    stage = stager(stats)
+
+    with stage('decode'):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+        size = targetsize(img.size, scale, output_size)
+        img = decode(img, size)
+
+        # Box-filter sources much larger than the output before sampling
+        factor = min(img.size[0] // size[0], img.size[1] // size[1])
+        source = img.reduce(factor) if factor > 1 else img
+        imgarray = np.asarray(source)
+
+    with stage('pose'):
+        reader = ExifReader(img)
+        r = getpose(reader, compass).T
+
+    columns = yawshift(r, size[0])
+    if columns is not None and source.size == size:
+        with stage('shift'):
+            rectified = shift(imgarray, columns)
+    else:
+        rectified = _rotate(imgarray, r, size, cache, backend, maptype,
+                            memory, threads, stage)
 
-    coord = getcoordinates(w, h, r)
-    rectified = remap(imgarray, coord)
     resultimg = Image.fromarray(rectified)
 
+    with stage('thumbnail'):
+        reader.thumbnail = _thumbnail(img, resultimg, reader.thumbnailsize,
+                                      r, thumbnail, cache, backend)
+
+    with stage('exif'):
+        _resetpose(reader, compass)
+        resultimg.info['exif'] = reader.tobytes()
+
+    return resultimg
+
+
+def _resetpose(reader, compass):
     # Rewrite gyroscope and compass data
     reader.theta[tag.ZENITH_ES] = (0, 0)
     if compass:
         reader.theta[tag.COMPASS_ES] = 0
         reader.gps[tag.GPS_IMG_DIRECTION] = 0
 
-    # Rewrite thumbnail
-    size = reader.thumbnail.size
-    reader.thumbnail = resultimg.resize(size, Image.ANTIALIAS)
 
-    resultimg.info['exif'] = reader.tobytes()
+class Equirect(object):
+    '''
+    Rectified equirectangular view of w x h.
+    '''
+    def __init__(self, w, h, name=None):
+        self.size = w, h
+        self.name = name
 
-    return resultimg
+    def key(self):
+        return ('equirect', ) + self.size
+
+    def sourcesize(self):
+        '''
+        Return the source size that has the resolution of the view.
+        '''
+        return self.size
+
+    def coordinates(self,
+                    sw,
+                    sh,
+                    r,
+                    backend=None,
+                    start=0,
+                    stop=None,
+                    maptype='float64'):
+        '''
+        Return coordinates of rows `start` to `stop` in a sw x sh source
+        rotated by `r`, as `getcoordinates` does.
+        '''
+        w, h = self.size
+        if stop is None:
+            stop = h
+
+        def generate(i, j, dtype):
+            band = getcoordinates(w, h, r, backend, i, j, dtype.name)
+            if (w, h) != (sw, sh):
+                scalecoordinates(band, w, h, sw, sh, band)
+            return band
+
+        return _buildmap(generate, w, start, stop, maptype)
+
+
+class Perspective(object):
+    '''
+    Pinhole view of w x h with a horizontal field of view of `fov`.
+
+    The view looks at `yaw` to the right and `pitch` upwards and is rolled
+    by `roll` clockwise, all in degrees from the center of the rectified
+    equirectangular image.
+    '''
+    def __init__(self, w, h, fov=90, yaw=0, pitch=0, roll=0, name=None):
+        if not 0 < fov < 180:
+            raise ValueError('Invalid field of view: {}'.format(fov))
+        self.size = w, h
+        self.fov = fov
+        self.yaw = yaw
+        self.pitch = pitch
+        self.roll = roll
+        self.name = name
+
+    def key(self):
+        return ('perspective', ) + self.size + (self.fov, self.yaw,
+                                                 self.pitch, self.roll)
+
+    def focal(self):
+        return self.size[0] / 2 / np.tan(np.deg2rad(self.fov) / 2)
+
+    def orientation(self):
+        '''
+        Return the rotation from the view to the rectified image.
+        '''
+        yaw, pitch, roll = np.deg2rad((self.yaw, self.pitch, self.roll))
+        return ry(yaw).dot(rx(pitch)).dot(rz(roll))
+
+    def sourcesize(self):
+        '''
+        Return the source size that has the resolution of the view center.
+        '''
+        f = self.focal()
+        return int(np.ceil(2 * np.pi * f)), int(np.ceil(np.pi * f))
+
+    def coordinates(self,
+                    sw,
+                    sh,
+                    r,
+                    backend=None,
+                    start=0,
+                    stop=None,
+                    maptype='float64'):
+        '''
+        Return coordinates of rows `start` to `stop` in a sw x sh source
+        rotated by `r`. `backend` is not used.
+        '''
+        w, h = self.size
+        if stop is None:
+            stop = h
+        f = self.focal()
+        m = np.asarray(r, np.float64).dot(self.orientation())
+        x = (np.arange(w) - (w - 1) / 2) / f
+
+        def generate(i, j, dtype):
+            # The direction of pixel (u, v) is (x, y, 1), so the rotated
+            # direction is a per-column plus a per-row term
+            y = (np.arange(i, j) - (h - 1) / 2) / f
+            xs, ys, zs = (np.add.outer(m[k, 1] * y + m[k, 2], m[k, 0] * x)
+                          for k in range(3))
+            coord = np.empty((2, j - i, w), dtype)
+            ys /= np.sqrt(xs * xs + ys * ys + zs * zs)
+            np.clip(ys, -1, 1, out=ys)
+            vv = np.arcsin(ys, out=ys)
+            vv *= sh / np.pi
+            vv += sh / 2
+            coord[0] = vv
+
+            uu = np.arctan2(xs, zs, out=xs)
+            uu *= sw / 2 / np.pi
+            uu += sw / 2
+            coord[1] = uu
+            return coord
+
+        return _buildmap(generate, w, start, stop, maptype)
+
+
+def cubefaces(size):
+    '''
+    Return the six `CUBE_FACES` views of size x size pixels.
+    '''
+    return [
+        Perspective(size, size, 90, yaw, pitch, name=name)
+        for name, (yaw, pitch) in CUBE_FACES.items()
+    ]
+
+
+def render(img,
+           views,
+           compass=False,
+           cache=None,
+           backend=None,
+           maptype='float32',
+           threads=None,
+           stats=None):
+    '''
+    Sample several views of a THETA image from one decode.
+
+    `views` are `Equirect` and `Perspective` views, e.g. from `cubefaces`.
+    The image is decoded once, with DCT scaling to the largest
+    `sourcesize` of the views, and every view is remapped from it with the
+    camera pose cancelled as `rectify` does. Coordinates are cached per view
+    in `cache` if given. If `threads` is given, views are remapped on that
+    many threads.
+
+    Returns images in the order of `views`. Equirectangular images have the
+    EXIF of the source with the pose reset and their own thumbnail.
+    '''
+    _checkmaptype(maptype)
+    stage = stager(stats)
+
+    with stage('decode'):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+        sizes = [view.sourcesize() for view in views]
+        size = max(w for w, _ in sizes), max(h for _, h in sizes)
+        img = decode(img, size)
+        imgarray = np.asarray(img)
+        sh, sw = imgarray.shape[:2]
+
+    with stage('pose'):
+        reader = ExifReader(img)
+        r = getpose(reader, compass).T
+
+    def work(view):
+        with stage('coordinates'):
+            if cache is not None:
+                coord = cache.get(sw, sh, r, view)
+            else:
+                coord = view.coordinates(sw, sh, r, backend, maptype=maptype)
+        with stage('remap'):
+            return Image.fromarray(remap(imgarray, coord))
+
+    if threads is not None and threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(work, views))
+    else:
+        results = [work(view) for view in views]
+
+    with stage('exif'):
+        _resetpose(reader, compass)
+        for view, result in zip(views, results):
+            if isinstance(view, Equirect):
+                reader.thumbnail = result.resize(reader.thumbnailsize,
+                                                 Image.BOX,
+                                                 reducing_gap=2.0)
+                result.info['exif'] = reader.tobytes()
+
+    return results
+
+
+def save(img, path, exif=False, stats=None):
+    '''
+    Save a rectified image as JPEG, optionally with its EXIF.
+
+    `path` may also be a binary file object.
+    '''
+    params = {}
+    if exif:
+        params['exif'] = img.info['exif']
+
+    if not isinstance(path, (str, os.PathLike)):
+        with stager(stats)('encode'):
+            img.save(NonJFIFHeaderFile(path), 'JPEG', **params)
+        return
+
+    try:
+        with open(path, 'wb') as fp, stager(stats)('encode'):
+            img.save(NonJFIFHeaderFile(fp), 'JPEG', **params)
+    except BaseException:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
 
 
 class NonJFIFHeaderFile():
@@ -0,0 +1,108 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from PIL import Image
+
+from thetaexif import ExifReader, aio, tag
+
+from . import testdata
+
+
+async def collect(agen):
+    return [item async for item in agen]
+
+
+class TestAio(unittest.TestCase):
+    def setUp(self):
+        self.image = testdata.prepare_image()
+        with open(self.image, 'rb') as fp:
+            self.data = fp.read()
+
+    def test_read_exif(self):
+        for src in (self.image, self.data):
+            reader = asyncio.run(aio.read_exif(src))
+            self.assertEqual(reader.theta[tag.COMPASS_ES],
+                             testdata.COMPASS_ES)
+
+    def test_read_exif_many(self):
+        results = asyncio.run(collect(aio.read_exif_many(
+            [self.image, b'broken', self.data])))
+        self.assertEqual([src for src, _, _ in results],
+                         [self.image, b'broken', self.data])
+        self.assertIsInstance(results[0][1], ExifReader)
+        self.assertIsInstance(results[1][2], ValueError)
+        self.assertIsNone(results[2][2])
+
+    def test_rectify(self):
+        data = asyncio.run(aio.rectify(self.data, exif=True, scale=0.25))
+        reader = ExifReader(data)
+        self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+        self.assertEqual(reader.img.size, (256, 128))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dst = os.path.join(tmp, 'out.jpg')
+            result = asyncio.run(aio.rectify(self.image, dst, scale=0.25))
+            self.assertEqual(result, dst)
+            with Image.open(dst) as img:
+                self.assertEqual(img.size, (256, 128))
+
+    def test_rectify_process(self):
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            data = asyncio.run(
+                aio.rectify(self.data, executor=executor, scale=0.25))
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (256, 128))
+
+    def test_rectify_many(self):
+        lock = threading.Lock()
+        count = peak = 0
+
+        class Executor(concurrent.futures.ThreadPoolExecutor):
+            def submit(self, fn, *args):
+                def work():
+                    nonlocal count, peak
+                    with lock:
+                        count += 1
+                        peak = max(peak, count)
+                    time.sleep(0.01)
+                    try:
+                        return fn(*args)
+                    finally:
+                        with lock:
+                            count -= 1
+
+                return super().submit(work)
+
+        async def jobs():
+            for i in range(4):
+                yield (b'broken' if i == 2 else self.data), None
+
+        async def main():
+            semaphore = asyncio.BoundedSemaphore(2)
+            with Executor(4) as executor:
+                return await collect(aio.rectify_many(jobs(),
+                                                      inflight=4,
+                                                      executor=executor,
+                                                      semaphore=semaphore,
+                                                      scale=0.125))
+
+        results = asyncio.run(main())
+        self.assertEqual(len(results), 4)
+        self.assertEqual(peak, 2)
+        for i, (src, result, error) in enumerate(results):
+            if i == 2:
+                self.assertEqual(src, b'broken')
+                self.assertIsNotNone(error)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(result[:2], b'\xff\xd8')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from thetaexif import catalog
+
+from . import testdata
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.image = testdata.prepare_image()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'images')
+        os.makedirs(os.path.join(self.root, 'sub'))
+        shutil.copyfile(self.image, os.path.join(self.root, 'a.jpg'))
+        shutil.copyfile(self.image, os.path.join(self.root, 'sub', 'b.jpg'))
+        with open(os.path.join(self.root, 'broken.jpg'), 'wb') as fp:
+            fp.write(b'broken')
+        self.db = catalog.Catalog(os.path.join(self.tmpdir.name, 'db.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_scan(self):
+        stats = self.db.scan(self.root)
+        self.assertEqual(stats,
+                         dict(updated=3,
+                              unchanged=0,
+                              removed=0,
+                              failed=1,
+                              skipped=0))
+
+        rows = self.db.select('error IS NULL')
+        self.assertEqual([os.path.basename(row['path']) for row in rows],
+                         ['a.jpg', 'b.jpg'])
+        row = rows[0]
+        self.assertEqual(row['zenith_z'], float(testdata.ZENITH_ES[0]))
+        self.assertEqual(row['zenith_x'], float(testdata.ZENITH_ES[1]))
+        self.assertEqual(row['compass'], float(testdata.COMPASS_ES))
+        self.assertGreater(row['tilt'], 24)
+        self.assertEqual(len(self.db.select('tilt > ?', 10)), 2)
+        self.assertEqual(len(self.db.select('tilt > ?', 90)), 0)
+        serial = row['serial']
+        self.assertEqual(len(self.db.select('serial = ?', serial)), 2)
+
+    def test_incremental(self):
+        self.db.scan(self.root)
+        stats = self.db.scan(self.root)
+        self.assertEqual(stats,
+                         dict(updated=0,
+                              unchanged=3,
+                              removed=0,
+                              failed=0,
+                              skipped=0))
+
+        os.unlink(os.path.join(self.root, 'sub', 'b.jpg'))
+        with open(os.path.join(self.root, 'broken.jpg'), 'ab') as fp:
+            fp.write(b'!')
+        stats = self.db.scan(self.root)
+        self.assertEqual(stats,
+                         dict(updated=1,
+                              unchanged=1,
+                              removed=1,
+                              failed=1,
+                              skipped=0))
+        self.assertEqual(len(self.db.select()), 2)
+
+    def test_malformed(self):
+        with open(self.image, 'rb') as fp:
+            data = fp.read()
+        # ZenithEs with a single value and CompassEs with two values
+        for name, entry, count in (('zenith.jpg', (0x0003, 10, 2), 1),
+                                   ('compass.jpg', (0x0004, 5, 1), 2)):
+            old = struct.pack('<HHI', *entry)
+            new = struct.pack('<HHI', entry[0], entry[1], count)
+            self.assertEqual(data.count(old), 1)
+            with open(os.path.join(self.root, name), 'wb') as fp:
+                fp.write(data.replace(old, new))
+
+        stats = self.db.scan(self.root)
+        self.assertEqual((stats['updated'], stats['failed']), (5, 3))
+        rows = self.db.select('error LIKE ?', 'Invalid %')
+        self.assertEqual([os.path.basename(row['path']) for row in rows],
+                         ['compass.jpg', 'zenith.jpg'])
+        self.assertIsNone(rows[0]['tilt'])
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'needs symlinks')
+    def test_errors(self):
+        self.db.scan(self.root)
+        os.symlink(os.path.join(self.root, 'missing.jpg'),
+                   os.path.join(self.root, 'link.jpg'))
+        sub = os.path.join(self.root, 'sub')
+        scandir = os.scandir
+
+        def denied(path):
+            if path == sub:
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        errors = []
+        with mock.patch('os.scandir', denied):
+            stats = self.db.scan(self.root,
+                                 onerror=lambda *args: errors.append(args))
+        self.assertEqual(
+            stats,
+            dict(updated=0, unchanged=2, removed=0, failed=0, skipped=2))
+        self.assertEqual(sorted(path for path, _ in errors),
+                         [os.path.join(self.root, 'link.jpg'), sub])
+        self.assertTrue(
+            all(isinstance(error, OSError) for _, error in errors))
+        # Records under unreadable directories are kept
+        self.assertEqual(len(self.db.select()), 3)
+
+        # Missing roots are reported instead of raising
+        stats = self.db.scan(os.path.join(self.root, 'missing'),
+                             onerror=lambda *args: errors.append(args))
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(len(errors), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,20 @@
+import contextlib
+import csv
+import io
+import json
 import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
 import unittest
 
+from PIL import Image
+
 from thetaexif import ExifReader, tag
-from thetaexif.cli import parse
+from thetaexif.cli import destinations, expand, parse
+from thetaexif.exif import find_exif
 
 from . import testdata
 
@@ -39,6 +51,246 @@ class TestCLI(unittest.TestCase):
         reader.img.fp.close()
         os.unlink(self.rectified)
 
+    def test_rectify_jobs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            subdir = os.path.join(tmpdir, 'sub')
+            os.makedirs(subdir)
+            image = os.path.join(subdir, os.path.basename(self.image))
+            shutil.copyfile(self.image, image)
+            outdir = os.path.join(tmpdir, 'out')
+
+            ret = parse(
+                ['rectify', self.image, image, '-j', '2', '-d', outdir, '-e'])
+            self.assertEqual(ret, 0)
+            self.assertEqual(sorted(os.listdir(outdir)),
+                             ['test.jpg', 'test_1.jpg'])
+            for name in os.listdir(outdir):
+                reader = ExifReader(os.path.join(outdir, name))
+                self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+
+    def test_rectify_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ret = parse(['rectify', self.image, '-p', '-d', tmpdir, '-e'])
+            self.assertEqual(ret, 0)
+            reader = ExifReader(os.path.join(tmpdir, 'test.jpg'))
+            self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+
+            ret = parse(['rectify', self.image, '-p', '-j', '2'])
+            self.assertEqual(ret, 1)
+
+    def test_rectify_scale(self):
+        with Image.open(self.image) as img:
+            w, h = img.size
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'test.jpg')
+            for argv in (['-s', '0.25'], ['-p', '-s', '0.25']):
+                ret = parse(['rectify', self.image, '-d', tmpdir] + argv)
+                self.assertEqual(ret, 0)
+                with Image.open(output) as img:
+                    self.assertEqual(img.size, (w // 4, h // 4))
+
+            ret = parse(['rectify', self.image, '--size', '300', '150'])
+            self.assertEqual(ret, 0)
+            with Image.open(self.rectified) as img:
+                self.assertEqual(img.size, (300, 150))
+            os.unlink(self.rectified)
+
+            ret = parse(
+                ['rectify', self.image, '-s', '0.5', '--size', '300', '150'])
+            self.assertEqual(ret, 1)
+
+    def test_rectify_stats(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for argv in ([], ['-p'], ['-j', '2']):
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    ret = parse([
+                        'rectify', self.image, self.image, '-d', tmpdir,
+                        '--stats', 'json'
+                    ] + argv)
+                self.assertEqual(ret, 0)
+                records = [
+                    json.loads(line)
+                    for line in stdout.getvalue().splitlines()
+                ]
+                self.assertEqual([r['path'] for r in records],
+                                 [self.image, self.image, None])
+                self.assertEqual(records[-1]['stages']['encode']['count'], 2)
+                self.assertIn('remap', records[0]['stages'])
+
+    def test_rectify_on_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            missing = os.path.join(tmpdir, 'missing.jpg')
+            for policy in ('skip', 'retry'):
+                ret = parse([
+                    'rectify', missing, self.image, '-d', tmpdir,
+                    '--on-error', policy
+                ])
+                self.assertEqual(ret, 1)
+                self.assertTrue(
+                    os.path.exists(os.path.join(tmpdir, 'test.jpg')))
+                os.unlink(os.path.join(tmpdir, 'test.jpg'))
+
+            ret = parse(['rectify', missing, self.image, '-d', tmpdir])
+            self.assertEqual(ret, 1)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'test.jpg')))
+
+    def test_destinations(self):
+        self.assertEqual(destinations(['a/x.jpg', 'b/x.jpg', 'c/y.jpg'], 'o'),
+                         ['o/x.jpg', 'o/x_1.jpg', 'o/y.jpg'])
+        self.assertEqual(destinations(['a/x.jpg']), ['a/x_rectified.jpg'])
+
+    def info(self, argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ret = parse(['info'] + argv)
+        return ret, out.getvalue()
+
+    def test_info(self):
+        ret, out = self.info([self.image])
+        self.assertEqual(ret, 0)
+        self.assertIn('RICOH Marker Note', out)
+        self.assertIn('0x0003 [ZenithEs]: (20, -24)', out)
+
+    def test_jobs(self):
+        ret, out = self.info([self.image, '-j', '0'])
+        self.assertEqual(ret, 0)
+        self.assertIn('RICOH Marker Note', out)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(
+                    parse([
+                        'index',
+                        os.path.join(tmpdir, 'db.sqlite'), tmpdir, '-j', '0'
+                    ]), 0)
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                parse(['info', self.image, '-j', '-1'])
+        self.assertIn('must be 0 or more', stderr.getvalue())
+
+    def test_info_jsonl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copyfile(self.image, os.path.join(tmpdir, 'a.jpg'))
+            with open(os.path.join(tmpdir, 'b.jpg'), 'wb') as fp:
+                fp.write(b'broken')
+            with open(os.path.join(tmpdir, 'c.txt'), 'wb') as fp:
+                fp.write(b'ignored')
+
+            ret, out = self.info([tmpdir, '-f', 'jsonl'])
+            self.assertEqual(ret, 1)
+            records = [json.loads(line) for line in out.splitlines()]
+            self.assertEqual(len(records), 2)
+            self.assertEqual(records[0]['path'],
+                             os.path.join(tmpdir, 'a.jpg'))
+            self.assertEqual(records[0]['theta']['ZenithEs'],
+                             [float(v) for v in testdata.ZENITH_ES])
+            self.assertEqual(records[0]['theta']['CompassEs'],
+                             float(testdata.COMPASS_ES))
+            self.assertIsInstance(records[0]['makernote']['SerialNumber'],
+                                  str)
+            self.assertIn('error', records[1])
+
+    def test_info_truncated(self):
+        with open(self.image, 'rb') as fp:
+            data = fp.read()
+        offset, payload = find_exif(data)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Exif segments without IFDs and cut in the middle of IFD0
+            empty = b'Exif\x00\x00II*\x00' + bytes(4)
+            for name, exif in (('a.jpg', empty), ('b.jpg', payload[:64])):
+                with open(os.path.join(tmpdir, name), 'wb') as fp:
+                    fp.write(data[:offset - 4])
+                    fp.write(struct.pack('>HH', 0xffe1, len(exif) + 2))
+                    fp.write(exif)
+                    fp.write(data[offset + len(payload):])
+            shutil.copyfile(self.image, os.path.join(tmpdir, 'c.jpg'))
+
+            for fmt in ('text', 'csv'):
+                ret, out = self.info([tmpdir, '-f', fmt])
+                self.assertEqual(ret, 1)
+            ret, out = self.info([tmpdir, '-f', 'jsonl'])
+            self.assertEqual(ret, 1)
+            records = [json.loads(line) for line in out.splitlines()]
+            self.assertEqual(['error' in record for record in records],
+                             [True, True, False])
+
+    def test_info_csv(self):
+        ret, out = self.info([self.image, '-f', 'csv'])
+        self.assertEqual(ret, 0)
+        rows = list(csv.DictReader(io.StringIO(out)))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(float(rows[0]['theta.CompassEs']),
+                         float(testdata.COMPASS_ES))
+        self.assertEqual(rows[0]['error'], '')
+
+    def test_expand(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('b.JPG', 'a.jpg', 'c.png', 'sub/d.jpeg'):
+                path = os.path.join(tmpdir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'wb').close()
+            self.assertEqual(
+                [os.path.relpath(p, tmpdir) for p in expand([tmpdir])],
+                ['a.jpg', 'b.JPG', os.path.join('sub', 'd.jpeg')])
+            self.assertEqual(list(expand([os.path.join(tmpdir, '*.jpg')])),
+                             [os.path.join(tmpdir, 'a.jpg')])
+
+    def test_patch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'patched.jpg')
+            shutil.copyfile(self.image, path)
+
+            self.assertEqual(parse(['patch', path, '-z', '0', '0']), 0)
+            reader = ExifReader(path)
+            self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+            self.assertEqual(reader.theta[tag.COMPASS_ES], testdata.COMPASS_ES)
+
+            self.assertEqual(parse(['patch', path, '-c', '0']), 0)
+            reader = ExifReader(path)
+            self.assertEqual(reader.theta[tag.COMPASS_ES], 0)
+            self.assertEqual(reader.gps[tag.GPS_IMG_DIRECTION], 0)
+
+            self.assertEqual(parse(['patch', path, '-t']), 0)
+            reader = ExifReader(path)
+            self.assertEqual(reader.thumbnailsize,
+                             ExifReader(self.image).thumbnailsize)
+            self.assertEqual(parse(['patch', path]), 1)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                self.assertEqual(parse(['patch', path, '-c', '-1']), 1)
+            self.assertIn('Invalid value', stdout.getvalue())
+
+
+class TestImports(unittest.TestCase):
+    def run_python(self, code):
+        return subprocess.run([sys.executable, '-c', code],
+                              check=True,
+                              stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout.split()
+
+    def test_metadata_without_numpy(self):
+        image = testdata.prepare_image()
+        code = '''if True:
+            import contextlib, io, sys
+            import thetaexif
+            from thetaexif import cli
+            thetaexif.ExifReader({0!r}).theta
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli.parse(['info', {0!r}])
+            print(*sorted({{name.split('.')[0] for name in sys.modules}}))
+        '''.format(image)
+        modules = self.run_python(code)
+        for name in ('numpy', 'PIL', 'scipy'):
+            self.assertNotIn(name, modules)
+
+    def test_lazy_rectify(self):
+        from thetaexif import projection, rectify
+        self.assertIs(rectify, projection.rectify)
+
+    def test_backend_names(self):
+        from thetaexif import constants, projection
+        self.assertLessEqual(set(projection.BACKENDS),
+                             set(constants.BACKEND_NAMES))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,19 +1,33 @@
+import io
+import mmap
+import os
+import shutil
+import tempfile
 import unittest
 from fractions import Fraction
 
+import numpy as np
 from PIL import Image
-from scipy import misc
 
 from thetaexif import tag
-from thetaexif.exif import ExifReader, TagReader
+from thetaexif.exif import (ExifReader, Handler, TagReader, find_exif,
+                            jpegsize, metadata, patch, splice)
 
 from . import testdata
 
 
+def unpack_one(handler, data, offset):
+    # Reference decoding of a single value
+    unpacked = handler.formatter.unpack_from(data, offset)
+    if len(unpacked) == 1:
+        return unpacked[0]
+    return Fraction(*unpacked)
+
+
 class TestExif(unittest.TestCase):
     def setUp(self):
         self.image = testdata.prepare_image()
-        self.image_wo_exif = Image.fromarray(misc.face())
+        self.image_wo_exif = Image.new('RGB', (64, 32))
 
     def test_exifreader_load_without_exif(self):
         img = self.image_wo_exif
@@ -31,6 +45,44 @@ class TestExif(unittest.TestCase):
         with Image.open(self.image) as img:
             ExifReader(img)
 
+    def test_exifreader_load_bytes(self):
+        with open(self.image, 'rb') as fp:
+            data = fp.read()
+        reader = ExifReader(data)
+        self.assertEqual(reader.theta[tag.ZENITH_ES], testdata.ZENITH_ES)
+
+    def test_exifreader_load_mmap(self):
+        with open(self.image, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with ExifReader(mm) as reader:
+                self.assertEqual(reader.theta[tag.ZENITH_ES],
+                                 testdata.ZENITH_ES)
+
+    def test_exifreader_header_only(self):
+        reader = ExifReader(self.image)
+        self.assertIsNone(reader._img)
+        self.assertEqual(reader.theta[tag.COMPASS_ES], testdata.COMPASS_ES)
+        self.assertIsNone(reader._img)
+
+        with open(self.image, 'rb') as fp:
+            fp.seek(reader.offset)
+            self.assertIn(fp.read(4), (b'II*\x00', b'MM\x00*'))
+
+    def test_find_exif(self):
+        offset, payload = find_exif(self.image)
+        self.assertTrue(payload.startswith(ExifReader.EXIF_ID_CODE))
+        with Image.open(self.image) as img:
+            self.assertEqual(payload, img.info['exif'])
+
+        self.assertRaises(ValueError, find_exif, b'GIF89a')
+
+    def test_jpegsize(self):
+        with Image.open(self.image) as img:
+            self.assertEqual(jpegsize(self.image), img.size)
+        reader = ExifReader(self.image)
+        self.assertEqual(reader.thumbnailsize, reader.thumbnail.size)
+        self.assertRaises(ValueError, jpegsize, b'\xff\xd8\xff\xd9')
+
     def test_exifreader_read(self):
         reader = ExifReader(self.image)
 
@@ -65,6 +117,193 @@ class TestExif(unittest.TestCase):
 
         self.assertNotEqual(reader.tobytes(), reader.img.info['exif'])
 
+    def test_exifreader_zero_copy(self):
+        with open(self.image, 'rb') as fp:
+            data = fp.read()
+        reader = ExifReader(data)
+        self.assertIs(reader.buffer.view.obj, data)
+
+        thumbnail = reader.thumbnaildata
+        self.assertIs(thumbnail.obj, data)
+        self.assertEqual(thumbnail[:2], b'\xff\xd8')
+        self.assertEqual(reader.thumbnail.format, 'JPEG')
+
+    def test_exifreader_copy_on_write(self):
+        with open(self.image, 'rb') as fp:
+            data = fp.read()
+        original = bytes(data)
+        reader = ExifReader(data)
+        self.assertFalse(reader.buffer.writable)
+
+        reader.theta[tag.COMPASS_ES] = Fraction(1, 10)
+        self.assertTrue(reader.buffer.writable)
+        self.assertIsNot(reader.buffer.view.obj, data)
+        self.assertEqual(reader.theta[tag.COMPASS_ES], Fraction(1, 10))
+        self.assertEqual(data, original)
+
+    def test_synthetic(self):
+        fp = io.BytesIO()
+        testdata.make_image(fp, (64, 32), (Fraction(3, 2), 0), 90, (32, 16))
+        reader = ExifReader(fp.getvalue())
+        self.assertEqual(reader.theta[tag.ZENITH_ES], (Fraction(3, 2), 0))
+        self.assertEqual(reader.theta[tag.COMPASS_ES], 90)
+        self.assertEqual(reader.gps[tag.GPS_IMG_DIRECTION], 90)
+        self.assertEqual(reader.makernote[tag.FIRMWARE_VERSION], b'Rev0102')
+        self.assertEqual(reader.thumbnailsize, (32, 16))
+        self.assertEqual(jpegsize(fp.getvalue()), (64, 32))
+
+    def test_handler(self):
+        for handlers in (Handler.lehandlers, Handler.behandlers):
+            values = {
+                1: (1, 255),
+                3: (1, 65535, 3),
+                4: (1, 2**32 - 1),
+                5: (Fraction(1, 3), Fraction(45, 2)),
+                8: (-1, 2),
+                10: (Fraction(-24), Fraction(1, 7)),
+                12: (0.5, -2.25),
+            }
+            for typeid, value in values.items():
+                handler = handlers[typeid]
+                data = handler.pack(value)
+                self.assertEqual(len(data), handler.size * len(value))
+                self.assertEqual(handler.unpack(data, len(value)), value)
+            self.assertEqual(handlers[7].unpack(b'abc', 3), b'abc')
+
+    def test_tagreader_values(self):
+        reader = ExifReader(self.image)
+        for ifd in (reader.makernote, reader.theta):
+            for key in ifd:
+                handler, num, offset = ifd.tags[key]
+                value = ifd[key]
+                if isinstance(value, TagReader):
+                    continue
+                single = tuple(
+                    unpack_one(handler, reader.buffer.view,
+                               offset + handler.size * i) for i in range(num))
+                if handler.typeid == 2:
+                    self.assertEqual(value, b''.join(single[:-1]))
+                elif handler.typeid == 7:
+                    self.assertEqual(value, b''.join(single))
+                elif num == 1:
+                    self.assertEqual(value, single[0])
+                else:
+                    self.assertEqual(value, single)
+
+        self.assertEqual(metadata(reader)['theta']['ZenithEs'],
+                         [float(v) for v in testdata.ZENITH_ES])
+
+    def test_patch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'patched.jpg')
+            shutil.copyfile(self.image, path)
+
+            patch(path, zenith=(0, 0), compass=Fraction(1, 2))
+
+            reader = ExifReader(path)
+            self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+            self.assertEqual(reader.theta[tag.COMPASS_ES], Fraction(1, 2))
+            self.assertEqual(reader.gps[tag.GPS_IMG_DIRECTION],
+                             Fraction(1, 2))
+
+            with open(self.image, 'rb') as fp:
+                original = fp.read()
+            with open(path, 'rb') as fp:
+                patched = fp.read()
+            self.assertEqual(len(original), len(patched))
+
+            spans = [
+                reader.theta.getspan(tag.ZENITH_ES),
+                reader.theta.getspan(tag.COMPASS_ES),
+                reader.gps.getspan(tag.GPS_IMG_DIRECTION),
+            ]
+            for i, (a, b) in enumerate(zip(original, patched)):
+                if a != b:
+                    i -= reader.offset
+                    self.assertTrue(
+                        any(start <= i < start + size
+                            for start, size in spans))
+
+            # Every value is checked before the first byte is written
+            self.assertRaises(ValueError,
+                              patch,
+                              path,
+                              zenith=(1, 1),
+                              compass=-1)
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), patched)
+
+
+class TestSplice(unittest.TestCase):
+    def setUp(self):
+        self.image = testdata.prepare_image()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def scan(self, path):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        # Entropy-coded data never contains a marker, so the last SOS is the
+        # one of the main image
+        return data[data.rfind(b'\xff\xda'):]
+
+    def test_replace(self):
+        with Image.open(self.image) as img:
+            pixels = np.asarray(img)
+
+        for size in ((320, 160), (16, 8)):
+            reader = ExifReader(self.image)
+            reader.theta[tag.ZENITH_ES] = (0, 0)
+            reader.thumbnail = Image.new('RGB', size)
+            output = self.path('output.jpg')
+            splice(self.image, output, reader.tobytes())
+
+            spliced = ExifReader(output)
+            self.assertEqual(spliced.theta[tag.ZENITH_ES], (0, 0))
+            self.assertEqual(spliced.theta[tag.COMPASS_ES],
+                             testdata.COMPASS_ES)
+            self.assertEqual(spliced.thumbnailsize, size)
+            self.assertEqual(self.scan(output), self.scan(self.image))
+            with Image.open(output) as img:
+                np.testing.assert_array_equal(np.asarray(img), pixels)
+
+    def test_patch_thumbnail(self):
+        path = self.path('patched.jpg')
+        reader = ExifReader(self.image)
+        size = reader.thumbnailsize
+        reader.thumbnail = Image.new('RGB', size)
+        splice(self.image, path, reader.tobytes())
+
+        patch(path, thumbnail=True)
+        reader = ExifReader(path)
+        self.assertEqual(reader.thumbnailsize, size)
+        with Image.open(path) as img:
+            expected = np.asarray(img.resize(size, Image.BOX), np.float32)
+        thumbnail = np.asarray(reader.thumbnail, np.float32)
+        np.testing.assert_allclose(thumbnail.mean((0, 1)),
+                                   expected.mean((0, 1)),
+                                   atol=2)
+        self.assertEqual(self.scan(path), self.scan(self.image))
+
+    def test_insert(self):
+        path = self.path('plain.jpg')
+        Image.new('RGB', (64, 32), 'red').save(path)
+        exif = ExifReader(self.image).tobytes()
+
+        splice(path, path, exif)
+        self.assertEqual(ExifReader(path).tobytes(), exif)
+        with open(path, 'rb') as fp:
+            # The JFIF segment stays first
+            self.assertEqual(fp.read(4), b'\xff\xd8\xff\xe0')
+        with Image.open(path) as img:
+            self.assertGreater(img.getpixel((0, 0))[0], 200)
+
+        self.assertRaises(ValueError, splice, path, path, b'JFIF')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['plain.jpg'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from thetaexif import ExifReader, tag
+from thetaexif.pipeline import Pipeline, rectify_files
+
+from . import testdata
+
+
+class TestPipeline(unittest.TestCase):
+    def test_submit(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        with Pipeline([lambda x: x + 1, fail, lambda x: x * 2]) as pipeline:
+            futures = [pipeline.submit(i) for i in range(5)]
+            self.assertEqual([f.result() for f in futures[:2]], [2, 4])
+            self.assertIsInstance(futures[2].exception(), ValueError)
+            self.assertEqual([f.result() for f in futures[3:]], [8, 10])
+
+    def test_inflight(self):
+        lock = threading.Lock()
+        count = peak = 0
+
+        def enter(x):
+            nonlocal count, peak
+            with lock:
+                count += 1
+                peak = max(peak, count)
+            return x
+
+        def leave(x):
+            nonlocal count
+            with lock:
+                count -= 1
+            return x
+
+        with Pipeline([enter, lambda x: x, leave], inflight=2) as pipeline:
+            futures = [pipeline.submit(i) for i in range(20)]
+            self.assertEqual([f.result() for f in futures], list(range(20)))
+        self.assertLessEqual(peak, 2)
+
+
+class TestRectifyFiles(unittest.TestCase):
+    def setUp(self):
+        self.image = testdata.prepare_image()
+
+    def test_rectify_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            missing = os.path.join(tmpdir, 'missing.jpg')
+            jobs = [(self.image, os.path.join(tmpdir, '0.jpg')),
+                    (missing, os.path.join(tmpdir, '1.jpg')),
+                    (self.image, os.path.join(tmpdir, '2.jpg'))]
+            results = list(rectify_files(jobs, exif=True, inflight=2))
+
+            self.assertEqual([r[:2] for r in results], jobs)
+            self.assertIsNone(results[0][2])
+            self.assertIsInstance(results[1][2], OSError)
+            self.assertIsNone(results[2][2])
+            for name in ('0.jpg', '2.jpg'):
+                reader = ExifReader(os.path.join(tmpdir, name))
+                self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, '1.jpg')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,577 @@
+import os
+import tempfile
+import tracemalloc
+import unittest
+from fractions import Fraction
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+from thetaexif import projection, tag
+from thetaexif.exif import ExifReader
+
+from . import testdata
+
+
+def getcoordinates_reference(w, h, r):
+    uu, vv = np.meshgrid(np.arange(w), np.arange(h))
+    t = (uu - w / 2) * 2 * np.pi / w
+    p = (vv - h / 2) * np.pi / h
+    st, ct = np.sin(t), np.cos(t)
+    sp, cp = np.sin(p), np.cos(p)
+    xyz = np.dstack((cp * st, sp, cp * ct))
+    xyz = np.einsum('ij,...j', r, xyz)
+    t = np.arctan2(xyz[:, :, 0], xyz[:, :, 2])
+    p = np.arcsin(xyz[:, :, 1])
+    uu = t * w / 2 / np.pi + w / 2
+    vv = p * h / np.pi + h / 2
+    return np.dstack((vv, uu)).transpose(2, 0, 1)
+
+
+class TestGetCoordinates(unittest.TestCase):
+    poses = [
+        np.eye(3),
+        projection.ry(np.pi / 3),
+        projection.rx(0.3).dot(projection.rz(-0.4)),
+        projection.ry(2).dot(projection.rx(-1).dot(projection.rz(0.5))),
+    ]
+    sizes = [(64, 32), (200, 100), (97, 51)]
+
+    def assertCoordinatesAlmostEqual(self, actual, desired, w, atol=1e-8):
+        diff = actual - desired
+        # Longitude wraps around
+        diff[1] = (diff[1] + w / 2) % w - w / 2
+        np.testing.assert_allclose(diff, 0, atol=atol)
+
+    def test_reference(self):
+        for w, h in self.sizes:
+            for r in self.poses:
+                coord = projection.getcoordinates(w, h, r, 'numpy')
+                self.assertEqual(coord.shape, (2, h, w))
+                self.assertCoordinatesAlmostEqual(
+                    coord, getcoordinates_reference(w, h, r), w)
+
+    def test_backends(self):
+        self.assertIn('numpy', projection.BACKENDS)
+        for backend in projection.BACKENDS:
+            for w, h in self.sizes:
+                for r in self.poses:
+                    coord = projection.getcoordinates(w, h, r, backend)
+                    expected = projection.getcoordinates(w, h, r, 'numpy')
+                    self.assertEqual(coord.shape, (2, h, w))
+                    # Longitude is undefined at the top pole row
+                    self.assertCoordinatesAlmostEqual(
+                        coord[:, 1:], expected[:, 1:], w)
+
+    def test_rows(self):
+        r = self.poses[2]
+        for backend in projection.BACKENDS:
+            coord = projection.getcoordinates(64, 32, r, backend)
+            band = projection.getcoordinates(64, 32, r, backend, 5, 17)
+            self.assertEqual(band.shape, (2, 12, 64))
+            np.testing.assert_allclose(band, coord[:, 5:17], atol=1e-5)
+
+    def test_getbackend(self):
+        numpy_backend = projection.BACKENDS['numpy']
+        with mock.patch.dict(os.environ):
+            os.environ.pop('THETAEXIF_BACKEND', None)
+            self.assertIs(projection.getbackend(),
+                          next(iter(projection.BACKENDS.values())))
+            os.environ['THETAEXIF_BACKEND'] = 'numpy'
+            self.assertIs(projection.getbackend(), numpy_backend)
+        self.assertRaises(ValueError, projection.getbackend, 'unknown')
+
+
+def remap_reference(imgarray, coordinates):
+    h, w = imgarray.shape[:2]
+    result = np.empty(coordinates.shape[1:] + imgarray.shape[2:])
+    for i, j in np.ndindex(*coordinates.shape[1:]):
+        v, u = coordinates[:, i, j]
+        v0, u0 = int(np.floor(v)), int(np.floor(u))
+        fv, fu = v - v0, u - u0
+        value = 0
+        for dv, wv in ((0, 1 - fv), (1, fv)):
+            for du, wu in ((0, 1 - fu), (1, fu)):
+                vi = min(max(v0 + dv, 0), h - 1)
+                ui = (u0 + du) % w
+                value = value + wv * wu * imgarray[vi, ui].astype(float)
+        result[i, j] = value
+    return result
+
+
+class TestRemap(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.img = rng.randint(0, 256, (16, 32, 3)).astype(np.uint8)
+
+    def test_identity(self):
+        coord = np.array(np.mgrid[0:16, 0:32], np.float64)
+        np.testing.assert_array_equal(projection.remap(self.img, coord),
+                                      self.img)
+
+    def test_reference(self):
+        r = projection.rx(0.3).dot(projection.rz(-0.4))
+        coord = projection.getcoordinates(32, 16, r)
+        # Sample beyond the poles and across the seam
+        coord[0, 0] = -0.7
+        coord[0, -1] = 15.6
+        coord[1, :, 0] = 31.5
+        coord[1, :, 1] = -0.25
+        remapped = projection.remap(self.img, coord)
+        self.assertEqual(remapped.dtype, np.uint8)
+        expected = remap_reference(self.img, coord)
+        np.testing.assert_allclose(remapped, expected, atol=0.5 + 1e-3)
+
+    def test_grayscale(self):
+        coord = projection.getcoordinates(32, 16, projection.ry(0.5))
+        remapped = projection.remap(self.img[..., 0], coord)
+        self.assertEqual(remapped.shape, (16, 32))
+        expected = projection.remap(self.img, coord)[..., 0]
+        np.testing.assert_array_equal(remapped, expected)
+
+
+class TestMapTypes(unittest.TestCase):
+    def setUp(self):
+        self.r = projection.rx(0.3).dot(projection.rz(-0.4))
+        self.reference = projection.getcoordinates(200, 100, self.r)
+
+    def test_nbytes(self):
+        for maptype, nbytes in projection.MAP_TYPES.items():
+            for backend in projection.BACKENDS:
+                coord = projection.getcoordinates(200, 100, self.r, backend,
+                                                  maptype=maptype)
+                self.assertEqual(coord.nbytes, 200 * 100 * nbytes)
+        self.assertRaises(ValueError, projection.getcoordinates, 200, 100,
+                          self.r, maptype='float16')
+
+    def test_accuracy(self):
+        # Bilinear weights are off by at most 2^-9 in fixed point
+        for maptype, atol in (('float32', 1e-3), ('fixed', 2**-9 + 1e-3)):
+            coord = projection.getcoordinates(200, 100, self.r,
+                                              maptype=maptype)
+            if projection.isfixed(coord):
+                coord = projection.fromfixed(coord)
+            diff = coord - self.reference
+            diff[1] = (diff[1] + 100) % 200 - 100
+            np.testing.assert_allclose(diff[:, 1:], 0, atol=atol)
+
+    def test_remap(self):
+        with Image.open(testdata.prepare_image()) as img:
+            imgarray = np.asarray(img)
+        h, w = imgarray.shape[:2]
+        expected = projection.remap(
+            imgarray, projection.getcoordinates(w, h, self.r)).astype(float)
+        for maptype, mean in (('float32', 1e-3), ('fixed', 0.05)):
+            coord = projection.getcoordinates(w, h, self.r, maptype=maptype)
+            diff = np.abs(projection.remap(imgarray, coord) - expected)
+            self.assertLessEqual(diff.max(), 1)
+            self.assertLess(diff.mean(), mean)
+
+        output = np.empty((h, w + 1) + imgarray.shape[2:], imgarray.dtype)
+        coord = projection.getcoordinates(w, h, self.r)
+        self.assertRaises(ValueError, projection.remap, imgarray, coord,
+                          output[:, :w])
+
+    def test_peak(self):
+        # Temporaries are bounded by blocks, not by the image size
+        w, h = 2048, 1024
+        block = projection.COORDINATE_BLOCK_PIXELS * 64
+        for maptype, nbytes in projection.MAP_TYPES.items():
+            tracemalloc.start()
+            try:
+                projection.getcoordinates(w, h, self.r, 'numpy',
+                                          maptype=maptype)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertLess(peak, w * h * nbytes + block)
+
+    def test_fixed(self):
+        coord = np.array([[[0.0, 10.5, 99.99], [-0.5, 0.25, 7.004]],
+                          [[0.0, 199.5, 3.75], [-0.25, 200.0, 0.126]]])
+        fixed = projection.tofixed(coord)
+        self.assertEqual(fixed.dtype, np.int16)
+        self.assertTrue(projection.isfixed(fixed))
+        np.testing.assert_allclose(projection.fromfixed(fixed), coord,
+                                   atol=2**-9)
+        np.testing.assert_array_equal(fixed[:2],
+                                      np.floor(coord * 256 + 0.5) // 256)
+
+        # Integer parts wrap around beyond int16
+        self.assertRaises(ValueError, projection.tofixed, coord + 32767.9)
+        self.assertRaises(ValueError, projection.tofixed, coord - 32768.5)
+        self.assertRaises(ValueError,
+                          projection.getcoordinates,
+                          40000,
+                          2,
+                          np.eye(3),
+                          maptype='fixed')
+
+    def test_rectify(self):
+        with Image.open(testdata.prepare_image()) as img:
+            expected = np.asarray(projection.rectify(img, True), float)
+            for maptype in projection.MAP_TYPES:
+                cache = projection.CoordinateCache(maptype=maptype)
+                for rectified in (projection.rectify(img, True,
+                                                     maptype=maptype),
+                                  projection.rectify(img, True, cache=cache)):
+                    np.testing.assert_allclose(rectified, expected, atol=1)
+                self.assertTrue(
+                    all(k[-1] == maptype for k in cache._entries))
+            self.assertRaises(ValueError, projection.rectify, img,
+                              maptype='float16')
+
+
+class TestCoordinateCache(unittest.TestCase):
+    def setUp(self):
+        self.r = projection.rx(0.2).dot(projection.rz(-0.3))
+
+    def test_get(self):
+        cache = projection.CoordinateCache()
+        coord = cache.get(64, 32, self.r)
+        np.testing.assert_array_equal(
+            coord, projection.getcoordinates(64, 32, self.r,
+                                             maptype='float32'))
+        self.assertIs(cache.get(64, 32, self.r), coord)
+        self.assertIs(cache.get(64, 32, self.r + 1e-7), coord)
+        self.assertIsNot(cache.get(64, 32, self.r + 1e-3), coord)
+        self.assertIsNot(cache.get(32, 16, self.r), coord)
+        self.assertEqual(len(cache), 3)
+
+    def test_maxbytes(self):
+        nbytes = 64 * 32 * projection.MAP_TYPES['float32']
+        cache = projection.CoordinateCache(maxbytes=2 * nbytes)
+        for angle in (0.1, 0.2, 0.3):
+            cache.get(64, 32, projection.ry(angle))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 2 * nbytes)
+
+        cache = projection.CoordinateCache(maxbytes=nbytes - 1)
+        cache.get(64, 32, self.r)
+        self.assertEqual(len(cache), 0)
+
+    def test_threads(self):
+        for maptype in projection.MAP_TYPES:
+            cache = projection.CoordinateCache(maptype=maptype)
+            with mock.patch.object(projection,
+                                   'getcoordinates',
+                                   wraps=projection.getcoordinates) as get:
+                coord = cache.get(64, 32, self.r, threads=3)
+            # One tile per call
+            self.assertEqual(get.call_count, 11)
+            np.testing.assert_array_equal(
+                coord,
+                projection.getcoordinates(64, 32, self.r, maptype=maptype))
+
+    def test_fits(self):
+        nbytes = 64 * 32 * projection.MAP_TYPES['float32']
+        self.assertTrue(projection.CoordinateCache(nbytes).fits(64, 32))
+        cache = projection.CoordinateCache(nbytes - 1)
+        self.assertFalse(cache.fits(64, 32))
+        cache.directory = 'cache'
+        self.assertTrue(cache.fits(64, 32))
+        cache.maxdiskbytes = nbytes - 1
+        self.assertFalse(cache.fits(64, 32))
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = projection.CoordinateCache(directory=tmpdir)
+            coord = cache.get(64, 32, self.r)
+
+            cache = projection.CoordinateCache(directory=tmpdir)
+            loaded = cache.get(64, 32, self.r)
+            self.assertIsInstance(loaded, np.memmap)
+            np.testing.assert_array_equal(loaded, coord)
+            del loaded
+
+            # Grids of other backends are computed, not loaded
+            for name in projection.BACKENDS:
+                cache = projection.CoordinateCache(directory=tmpdir,
+                                                   backend=name)
+                cache.get(64, 32, self.r)
+            self.assertEqual(len(os.listdir(tmpdir)),
+                             len(projection.BACKENDS))
+
+    def test_maxdiskbytes(self):
+        nbytes = 64 * 32 * projection.MAP_TYPES['float32']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = projection.CoordinateCache(directory=tmpdir,
+                                               maxdiskbytes=2 * nbytes + 256)
+            paths = []
+            for angle in (0.1, 0.2, 0.3):
+                r = projection.ry(angle)
+                cache.get(64, 32, r)
+                paths.append(cache._path(cache.key(64, 32, r)))
+                # Make the order independent of the mtime resolution
+                os.utime(paths[-1], ns=(len(paths), len(paths)))
+                if len(paths) == 2:
+                    # Loading refreshes the first grid
+                    cache.clear()
+                    cache.get(64, 32, projection.ry(0.1))
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             sorted(os.path.basename(p)
+                                    for p in (paths[0], paths[2])))
+
+            cache = projection.CoordinateCache(directory=tmpdir,
+                                               maxdiskbytes=nbytes - 1)
+            cache.get(64, 32, self.r)
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+
+
+class TestRectify(unittest.TestCase):
+    def setUp(self):
+        self.image = testdata.prepare_image()
+
+    def test_memory(self):
+        with Image.open(self.image) as img:
+            w = img.size[0]
+            expected = np.asarray(projection.rectify(img, True))
+            for rows in (1, 7, 1000000):
+                memory = rows * w * projection.MAP_TYPES['float32']
+                rectified = projection.rectify(img, True, memory=memory)
+                np.testing.assert_array_equal(rectified, expected)
+
+    def test_threads(self):
+        with Image.open(self.image) as img:
+            # Bands of 5 rows
+            memory = 5 * img.size[0] * projection.MAP_TYPES['float32']
+            for backend in projection.BACKENDS:
+                expected = np.asarray(
+                    projection.rectify(img, True, backend=backend))
+                for threads in (2, 3, 8):
+                    rectified = projection.rectify(img,
+                                                   True,
+                                                   backend=backend,
+                                                   threads=threads)
+                    np.testing.assert_array_equal(rectified, expected)
+                rectified = projection.rectify(img,
+                                               True,
+                                               backend=backend,
+                                               memory=memory,
+                                               threads=3)
+                np.testing.assert_array_equal(rectified, expected)
+                rectified = projection.rectify(
+                    img, True, cache=projection.CoordinateCache(
+                        backend=backend), threads=3)
+                np.testing.assert_array_equal(rectified, expected)
+                # Grids which do not fit are not generated whole
+                cache = projection.CoordinateCache(0, backend=backend)
+                rectified = projection.rectify(img,
+                                               True,
+                                               cache=cache,
+                                               threads=3)
+                np.testing.assert_array_equal(rectified, expected)
+                self.assertEqual(len(cache), 0)
+
+    def test_yaw(self):
+        with Image.open(self.image) as img:
+            img.load()
+            imgarray = np.asarray(img)
+            w = imgarray.shape[1]
+            reader = ExifReader(img)
+            self.assertIsNone(
+                projection.yawshift(projection.getpose(reader, True).T, w))
+
+            reader.theta[tag.ZENITH_ES] = (0, 0)
+            # 45 degrees is an integer shift, 10 degrees is not
+            for compass in (45, 10, 0.5, 0):
+                reader.theta[tag.COMPASS_ES] = compass
+                img.info['exif'] = reader.tobytes()
+                r = projection.getpose(reader, True).T
+                columns = projection.yawshift(r, w)
+                self.assertAlmostEqual(columns, -compass / 360 * w)
+
+                expected = projection.remap(
+                    imgarray, projection.getcoordinates(w, imgarray.shape[0],
+                                                        r))
+                rectified = np.asarray(projection.rectify(img, True))
+                # The pole rows have no longitude
+                np.testing.assert_allclose(rectified[1:-1],
+                                           expected[1:-1],
+                                           atol=1)
+                if compass == 45:
+                    np.testing.assert_array_equal(
+                        rectified, np.roll(imgarray, w // 8, axis=1))
+
+            # Tilts by a small fraction of a pixel are negligible
+            h = imgarray.shape[0]
+            reader.theta[tag.COMPASS_ES] = 10
+            r = projection.getpose(reader, True).T
+            columns = projection.yawshift(r, w)
+            coord = projection.getcoordinates(w, h, r)
+            for zenith, shifted in ((Fraction(1, 1000), True), (1, False)):
+                reader.theta[tag.ZENITH_ES] = (zenith, 0)
+                r = projection.getpose(reader, True).T
+                if shifted:
+                    self.assertAlmostEqual(projection.yawshift(r, w), columns)
+                else:
+                    self.assertIsNone(projection.yawshift(r, w))
+
+                # Pixels away from the poles move by less than the tolerance
+                moved = np.abs(projection.getcoordinates(w, h, r) - coord)
+                moved[1] = np.minimum(moved[1], w - moved[1])
+                self.assertEqual(
+                    moved[:, h // 8:-h // 8].max() < projection.YAW_TOLERANCE,
+                    shifted)
+
+    def test_scale(self):
+        full = projection.rectify(self.image, True)
+        w, h = full.size
+        # Compare low frequencies; fine detail aliases differently
+        expected = np.asarray(full.resize((32, 16), Image.BOX), np.float32)
+        for kwargs, size in (({'scale': 0.5}, (w // 2, h // 2)),
+                             ({'scale': 0.125}, (w // 8, h // 8)),
+                             ({'output_size': (300, 150)}, (300, 150))):
+            rectified = projection.rectify(self.image, True, **kwargs)
+            self.assertEqual(rectified.size, size)
+            preview = np.asarray(rectified.resize((32, 16), Image.BOX),
+                                 np.float32)
+            self.assertLess(np.abs(preview - expected).mean(), 5)
+            reader = ExifReader(rectified)
+            self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+
+        self.assertRaises(ValueError,
+                          projection.rectify,
+                          self.image,
+                          scale=0.5,
+                          output_size=(300, 150))
+
+    def test_decode(self):
+        img = projection.decode(self.image, (10, 5))
+        w, h = Image.open(self.image).size
+        self.assertEqual(img.size, (w // 8, h // 8))
+        self.assertEqual(projection.targetsize((100, 50), scale=0.3),
+                         (30, 15))
+
+    def test_thumbnail(self):
+        with Image.open(self.image) as img:
+            size = ExifReader(img).thumbnailsize
+            for method in projection.THUMBNAIL_METHODS:
+                rectified = projection.rectify(img, True, thumbnail=method)
+                reader = ExifReader(rectified)
+                self.assertEqual(reader.thumbnailsize, size)
+                expected = np.asarray(rectified.resize(size, Image.LANCZOS),
+                                      np.float32)
+                thumbnail = np.asarray(reader.thumbnail, np.float32)
+                # Filters differ on fine detail but not on the content
+                np.testing.assert_allclose(thumbnail.mean((0, 1)),
+                                           expected.mean((0, 1)),
+                                           atol=2)
+                self.assertGreater(
+                    np.corrcoef(thumbnail.ravel(), expected.ravel())[0, 1],
+                    0.7)
+
+            self.assertRaises(ValueError,
+                              projection.rectify,
+                              img,
+                              thumbnail='lanczos')
+
+    def test_scalecoordinates(self):
+        coord = projection.getcoordinates(40, 20, np.eye(3))
+        scaled = projection.scalecoordinates(coord, 40, 20, 160, 80)
+        v, u = np.mgrid[:20, :40]
+        np.testing.assert_allclose(scaled[0, 1:], (v[1:] + 0.5) * 4 - 0.5,
+                                   atol=1e-4)
+        np.testing.assert_allclose(scaled[1, 1:], (u[1:] + 0.5) * 4 - 0.5,
+                                   atol=1e-3)
+
+
+class TestViews(unittest.TestCase):
+    def setUp(self):
+        self.image = testdata.prepare_image()
+
+    def test_perspective(self):
+        n = 8
+        sw, sh = 400, 200
+        faces = {view.name: view for view in projection.cubefaces(n)}
+        # Directions of pixel centers of the front face
+        x = (np.arange(n) - (n - 1) / 2) / (n / 2)
+        lon = np.arctan(x)[None, :]
+        lat = np.arctan(x[:, None] / np.sqrt(1 + x[None, :]**2))
+        for name, yaw in (('front', 0), ('right', 90), ('back', 180),
+                          ('left', -90)):
+            coord = faces[name].coordinates(sw, sh, np.eye(3))
+            self.assertEqual(coord.shape, (2, n, n))
+            np.testing.assert_allclose(coord[0], lat * sh / np.pi + sh / 2)
+            u = (lon + np.deg2rad(yaw)) * sw / 2 / np.pi + sw / 2
+            np.testing.assert_allclose((coord[1] - u + sw / 2) % sw - sw / 2,
+                                       0,
+                                       atol=1e-9)
+
+        # The poles are at the centers of the top and bottom faces
+        for name, v in (('up', 0), ('down', sh)):
+            view = projection.Perspective(3, 3, 90, pitch=faces[name].pitch)
+            coord = view.coordinates(sw, sh, np.eye(3))
+            self.assertAlmostEqual(coord[0, 1, 1], v)
+
+        # Seams of adjacent faces are one pixel apart
+        front = faces['front'].coordinates(sw, sh, np.eye(3))
+        right = faces['right'].coordinates(sw, sh, np.eye(3))
+        seam = sw / 2 + sw / 8
+        np.testing.assert_allclose(seam - front[1, :, -1],
+                                   right[1, :, 0] - seam)
+        self.assertRaises(ValueError, projection.Perspective, 8, 8, 180)
+
+    def test_pose(self):
+        r = projection.rx(0.3).dot(projection.ry(-0.4))
+        view = projection.Perspective(16, 12, 70, yaw=20, pitch=-10, roll=5)
+        coord = view.coordinates(400, 200, r)
+        # Rotating the view by the pose gives the same directions
+        m = r.dot(view.orientation())
+        yaw = np.rad2deg(np.arctan2(m[0, 2], m[2, 2]))
+        pitch = np.rad2deg(np.arcsin(-m[1, 2]))
+        center = projection.Perspective(1, 1, 70, yaw, pitch)
+        expected = center.coordinates(400, 200, np.eye(3))[:, 0, 0]
+        np.testing.assert_allclose(
+            view.coordinates(400, 200, r, start=5, stop=7)[:, 0],
+            coord[:, 5], atol=1e-9)
+        np.testing.assert_allclose(coord[:, 5:7, 7:9].mean((1, 2)), expected,
+                                   atol=0.1)
+        for maptype in ('float32', 'fixed'):
+            mapped = view.coordinates(400, 200, r, maptype=maptype)
+            if projection.isfixed(mapped):
+                mapped = projection.fromfixed(mapped)
+            np.testing.assert_allclose(mapped, coord, atol=2**-8)
+
+    def test_render(self):
+        views = [projection.Equirect(256, 128)] + projection.cubefaces(32)
+        views.append(projection.Perspective(40, 30, 60, yaw=30, name='crop'))
+        with mock.patch.object(projection,
+                               'decode',
+                               wraps=projection.decode) as decode:
+            results = projection.render(self.image, views, True)
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual([img.size for img in results],
+                         [view.size for view in views])
+
+        expected = projection.rectify(self.image, True, scale=0.25)
+        np.testing.assert_array_equal(results[0], expected)
+        reader = ExifReader(results[0])
+        self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+        self.assertEqual(reader.theta[tag.COMPASS_ES], 0)
+        self.assertNotIn('exif', results[1].info)
+
+        cache = projection.CoordinateCache()
+        for threads in (None, 3):
+            cached = projection.render(self.image, views, True, cache=cache,
+                                       threads=threads)
+            for result, expected in zip(cached, results):
+                np.testing.assert_array_equal(result, expected)
+        self.assertEqual(len(cache), len(views))
+
+    def test_cache(self):
+        r = projection.rx(0.2)
+        cache = projection.CoordinateCache(maptype='fixed')
+        front, right = projection.cubefaces(16)[:2]
+        coord = cache.get(400, 200, r, front)
+        np.testing.assert_array_equal(
+            coord, front.coordinates(400, 200, r, maptype='fixed'))
+        self.assertIs(cache.get(400, 200, r, front), coord)
+        self.assertIsNot(cache.get(400, 200, r, right), coord)
+        self.assertIsNot(cache.get(400, 200, r), coord)
+        self.assertEqual(len(cache), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+from thetaexif import projection
+from thetaexif.stats import Stats, stager
+
+from . import testdata
+
+
+class TestStats(unittest.TestCase):
+    def test_stage(self):
+        stats = Stats()
+        for _ in range(2):
+            with stats.stage('sleep'):
+                time.sleep(0.01)
+        with self.assertRaises(KeyError):
+            with stats.stage('fail'):
+                raise KeyError
+
+        self.assertEqual(list(stats.stages), ['sleep', 'fail'])
+        entry = stats.stages['sleep']
+        self.assertEqual(entry['count'], 2)
+        self.assertGreaterEqual(entry['wall'], 0.02)
+        # Sleeping does not use the CPU
+        self.assertLess(entry['cpu'], entry['wall'])
+        self.assertIsNone(entry['peak'])
+        self.assertIn('sleep', stats.format())
+
+    def test_peak(self):
+        stats = Stats()
+        tracemalloc.start()
+        try:
+            with stats.stage('alloc'):
+                data = bytearray(1 << 22)
+                del data
+        finally:
+            tracemalloc.stop()
+        self.assertGreaterEqual(stats.stages['alloc']['peak'], 1 << 22)
+
+    def test_peak_without_reset(self):
+        # tracemalloc.reset_peak is missing before Python 3.9
+        stats = Stats()
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        if reset_peak is not None:
+            del tracemalloc.reset_peak
+        tracemalloc.start()
+        try:
+            with stats.stage('alloc'):
+                data = bytearray(1 << 22)
+                del data
+        finally:
+            tracemalloc.stop()
+            if reset_peak is not None:
+                tracemalloc.reset_peak = reset_peak
+        self.assertGreaterEqual(stats.stages['alloc']['peak'], 1 << 22)
+
+    def test_merge(self):
+        stats = Stats()
+        with stats.stage('a'):
+            pass
+        total = pickle.loads(pickle.dumps(stats))
+        total.merge(stats)
+        self.assertEqual(total.stages['a']['count'], 2)
+        self.assertEqual(total.asdict()['a']['wall'],
+                         2 * stats.stages['a']['wall'])
+
+        with stager(None)('a'):
+            pass
+
+    def test_rectify(self):
+        stats = Stats()
+        rectified = projection.rectify(testdata.prepare_image(),
+                                       True,
+                                       threads=2,
+                                       stats=stats)
+        self.assertEqual(
+            set(stats.stages),
+            {'decode', 'pose', 'coordinates', 'remap', 'thumbnail', 'exif'})
+        self.assertEqual(stats.stages['remap']['count'], 8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            projection.save(rectified,
+                            os.path.join(tmpdir, 'rectified.jpg'),
+                            stats=stats)
+        self.assertEqual(stats.stages['encode']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from thetaexif import ExifReader, tag
+from thetaexif.cli import parse
+from thetaexif.watch import Ingest, Spool, serve
+
+from . import testdata
+
+
+def copy(src, dst):
+    with open(src, 'rb') as fp:
+        data = fp.read()
+    with open(dst, 'wb') as fp:
+        fp.write(data)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data=b'x'):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'ab') as fp:
+            fp.write(data)
+        return path
+
+    def test_poll(self):
+        spool = Spool(self.tmp)
+        a = self.write('a.jpg')
+        self.write('.a.jpg.part')
+        self.write('notes.txt')
+        self.assertEqual(spool.poll(), [])
+        b = self.write('b.JPEG')
+        self.assertEqual(spool.poll(), [a])
+        # Growing files wait until they are unchanged for one poll
+        self.write('b.JPEG')
+        self.assertEqual(spool.poll(), [])
+        self.assertEqual(spool.poll(), [b])
+        self.assertEqual(spool.poll(), [])
+
+        # Changed and recreated files are reported again
+        self.write('a.jpg')
+        self.assertEqual(spool.poll(), [])
+        self.assertEqual(spool.poll(), [a])
+        os.unlink(b)
+        self.assertEqual(spool.poll(), [])
+        self.write('b.JPEG')
+        spool.poll()
+        self.assertEqual(spool.poll(), [b])
+
+    def test_settle(self):
+        spool = Spool(self.tmp, settle=False)
+        a = self.write('a.jpg')
+        self.assertEqual(spool.poll(), [a])
+        self.assertEqual(spool.poll(), [])
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.tmp, 'out')
+        os.mkdir(self.outdir)
+        self.log = []
+        self.release = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def work(self, src, dst):
+        self.release.wait()
+        if src.endswith('bad.jpg'):
+            with open(dst, 'wb') as fp:
+                fp.write(b'partial')
+            raise ValueError('broken')
+        if src.endswith('dir.jpg'):
+            # A partial output which cannot be unlinked
+            os.mkdir(dst)
+            raise ValueError('broken')
+        copy(src, dst)
+
+    def submit(self, src, dst):
+        return self.executor.submit(self.work, src, dst)
+
+    def source(self, name):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as fp:
+            fp.write(name.encode())
+        return path
+
+    def test_run(self):
+        ingest = Ingest(self.submit, self.outdir, 2,
+                        lambda *args: self.log.append(args))
+        sources = [self.source(name) for name in ('a.jpg', 'b.jpg', 'c.jpg',
+                                                  'bad.jpg')]
+        for src in sources:
+            self.assertTrue(ingest.add(src))
+        self.assertFalse(ingest.add(sources[0]))
+
+        ingest.step()
+        counters = ingest.counters()
+        self.assertEqual((counters['queued'], counters['running']), (2, 2))
+        # Outputs appear only when they are complete
+        self.assertEqual(os.listdir(self.outdir), [])
+
+        self.release.set()
+        ingest.run(once=True)
+        counters = ingest.counters()
+        self.assertEqual(counters['done'], 3)
+        self.assertEqual(counters['failed'], 1)
+        self.assertEqual((counters['queued'], counters['running']), (0, 0))
+        self.assertGreater(counters['images_per_second'], 0)
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.assertEqual(sorted(args[0] for args in self.log),
+                         sorted(sources))
+        errors = {src: error for src, _, error in self.log}
+        self.assertIsInstance(errors.pop(sources[-1]), ValueError)
+        self.assertEqual(set(errors.values()), {None})
+
+        # Up-to-date outputs are skipped unless forced
+        self.assertFalse(ingest.add(sources[0], force=False))
+        self.assertTrue(ingest.add(sources[0]))
+
+    def test_stop(self):
+        ingest = Ingest(self.submit, self.outdir, 1)
+        for name in ('a.jpg', 'b.jpg'):
+            ingest.add(self.source(name))
+        ingest.step()
+        ingest.stop()
+        self.assertFalse(ingest.add(self.source('c.jpg')))
+        self.release.set()
+        ingest.run()
+        self.assertEqual(os.listdir(self.outdir), ['a.jpg'])
+
+    def test_stop_locked(self):
+        # Signal handlers call stop while the lock may be held
+        ingest = Ingest(self.submit, self.outdir)
+        with ingest._lock:
+            thread = threading.Thread(target=ingest.stop)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertFalse(ingest.add(self.source('a.jpg')))
+
+    def test_unlink_error(self):
+        ingest = Ingest(self.submit, self.outdir, 1,
+                        lambda *args: self.log.append(args))
+        ingest.add(self.source('dir.jpg'))
+        ingest.add(self.source('a.jpg'))
+        self.release.set()
+        ingest.run(once=True)
+        self.assertEqual((ingest.done, ingest.failed), (1, 1))
+
+    def test_collision(self):
+        src = self.source('a.jpg')
+        os.mkdir(os.path.join(self.tmp, 'sub'))
+        other = self.source(os.path.join('sub', 'a.jpg'))
+        ingest = Ingest(self.submit, self.outdir)
+        self.assertTrue(ingest.add(src))
+        self.assertRaises(ValueError, ingest.add, other)
+        self.release.set()
+        ingest.run(once=True)
+        self.assertFalse(ingest.add(src, force=False))
+        self.assertRaises(ValueError, ingest.add, other, force=False)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs unix sockets')
+    def test_serve(self):
+        ingest = Ingest(self.submit, self.outdir)
+        path = os.path.join(self.tmp, 'socket')
+        server = serve(ingest, path)
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+                fp = sock.makefile('rwb')
+
+                def request(line):
+                    fp.write(line.encode() + b'\n')
+                    fp.flush()
+                    return json.loads(fp.readline().decode())
+
+                src = self.source('a.jpg')
+                self.assertEqual(request(src), {
+                    'path': src,
+                    'queued': True,
+                    'depth': 1
+                })
+                self.assertFalse(request(src)['queued'])
+                self.assertIn('error', request('a.jpg'))
+                self.assertIn('error', request(src + '.missing'))
+                os.mkdir(os.path.join(self.tmp, 'sub'))
+                self.assertIn('error',
+                              request(self.source(os.path.join('sub',
+                                                               'a.jpg'))))
+                self.assertEqual(request('stats')['queued'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Only sockets are replaced
+        server = serve(ingest, path)
+        server.shutdown()
+        server.server_close()
+        path = self.source('b.jpg')
+        self.assertRaises(ValueError, serve, ingest, path)
+        self.assertTrue(os.path.isfile(path))
+
+
+class TestWatchCommand(unittest.TestCase):
+    def test_once(self):
+        image = testdata.prepare_image()
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = os.path.join(tmp, 'spool')
+            outdir = os.path.join(tmp, 'out')
+            os.mkdir(spool)
+            for name in ('a.jpg', 'b.jpg'):
+                shutil.copyfile(image, os.path.join(spool, name))
+
+            argv = ['watch', spool, '-d', outdir, '-e', '--once']
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                self.assertEqual(parse(argv), 0)
+            self.assertIn('2 rectified, 0 failed', stderr.getvalue())
+            self.assertEqual(sorted(os.listdir(outdir)), ['a.jpg', 'b.jpg'])
+            reader = ExifReader(os.path.join(outdir, 'a.jpg'))
+            self.assertEqual(reader.theta[tag.ZENITH_ES], (0, 0))
+
+            # Outputs newer than their sources are not rectified again
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                self.assertEqual(parse(argv), 0)
+            self.assertIn('0 rectified', stderr.getvalue())
+
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(parse(['watch', spool, '-d', spool]), 1)
+                self.assertEqual(parse(['watch', '-d', outdir]), 1)
+                self.assertEqual(
+                    parse(['watch', spool, '-d', outdir, '--socket', image]),
+                    1)
+
+    @unittest.skipUnless(os.name == 'posix', 'needs POSIX signals')
+    def test_sigterm(self):
+        image = testdata.prepare_image()
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = os.path.join(tmp, 'spool')
+            outdir = os.path.join(tmp, 'out')
+            os.mkdir(spool)
+            shutil.copyfile(image, os.path.join(spool, 'a.jpg'))
+
+            def terminate():
+                deadline = time.monotonic() + 30
+                while (not os.path.exists(os.path.join(outdir, 'a.jpg'))
+                       and time.monotonic() < deadline):
+                    time.sleep(0.01)
+                os.kill(os.getpid(), signal.SIGTERM)
+
+            handler = signal.getsignal(signal.SIGTERM)
+            thread = threading.Thread(target=terminate)
+            thread.start()
+            argv = ['watch', spool, '-d', outdir, '--interval', '0.05']
+            try:
+                with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                    self.assertEqual(parse(argv), 0)
+            finally:
+                thread.join()
+            self.assertIn('1 rectified, 0 failed', stderr.getvalue())
+            self.assertEqual(os.listdir(outdir), ['a.jpg'])
+            self.assertIs(signal.getsignal(signal.SIGTERM), handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
+import io
 import os
 import shutil
+import struct
 import urllib.request
 from fractions import Fraction
 
+import numpy as np
+from PIL import Image
+
 URL = ('https://theta360.s3.amazonaws.com'
        '/d32805ec-c37d-11e3-ac04-52540092ec69-1/equirectangular')
 ZENITH_ES = Fraction(200, 10), Fraction(-240, 10)
@@ -10,14 +15,159 @@ COMPASS_ES = Fraction(225, 10)
 
 
 def prepare_image():
-    image = 'var/test.jpg'
+    '''
+    Return the path of the test image, which is made in var/ on first use.
+
+    It is a synthetic image with the pose of the reference image. If
+    $THETAEXIF_DOWNLOAD is set, the reference image is downloaded instead.
+    '''
+    download = bool(os.environ.get('THETAEXIF_DOWNLOAD'))
+    image = 'var/reference/test.jpg' if download else 'var/test.jpg'
 
     if not os.path.exists(image):
-        dir = os.path.dirname(image)
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-        req = urllib.request.urlopen(URL)
-        with open(image, 'wb') as fp:
-            shutil.copyfileobj(req, fp)
+        os.makedirs(os.path.dirname(image), exist_ok=True)
+        # Concurrent test runs write their own file; open() applies the umask
+        tmp = '{}.{}.part'.format(image, os.getpid())
+        try:
+            with open(tmp, 'wb') as fp:
+                if download:
+                    with urllib.request.urlopen(URL, timeout=30) as req:
+                        shutil.copyfileobj(req, fp)
+                else:
+                    make_image(fp)
+            os.replace(tmp, image)
+        except BaseException:
+            os.unlink(tmp)
+            raise
 
     return image
+
+
+def _rational(value, signed=False):
+    value = Fraction(value)
+    return struct.pack('<ii' if signed else '<II', value.numerator,
+                       value.denominator)
+
+
+def _ifdsize(entries):
+    size = 2 + 12 * len(entries) + 4
+    for _, _, _, payload in entries:
+        if len(payload) > 4:
+            size += len(payload) + len(payload) % 2
+    return size
+
+
+def _ifd(entries, offset, nextifd=0):
+    '''
+    Encode a little-endian IFD placed at `offset`.
+
+    `entries` are (tag, type, count, payload) tuples. Payloads longer than
+    4 bytes follow the entry table.
+    '''
+    table = struct.pack('<H', len(entries))
+    data = b''
+    dataoffset = offset + 2 + 12 * len(entries) + 4
+    for tagid, tagtype, count, payload in sorted(entries):
+        if len(payload) > 4:
+            table += struct.pack('<HHII', tagid, tagtype, count,
+                                 dataoffset + len(data))
+            data += payload + b'\0' * (len(payload) % 2)
+        else:
+            table += struct.pack('<HHI4s', tagid, tagtype, count, payload)
+    return table + struct.pack('<I', nextifd) + data
+
+
+def make_exif(thumbnail, zenith=ZENITH_ES, compass=COMPASS_ES):
+    '''
+    Return an APP1 Exif payload of a THETA image.
+
+    It has the Exif and GPS IFDs, the RICOH MakerNote with the THETA subdir
+    and IFD1 with the JPEG `thumbnail`.
+    '''
+    def pointer(tagid, offset=0):
+        return tagid, 4, 1, struct.pack('<I', offset)
+
+    theta = [
+        (0x0001, 4, 1, struct.pack('<I', 1)),
+        (0x0002, 4, 1, struct.pack('<I', 0)),
+        (0x0003, 10, 2, _rational(zenith[0], True) +
+         _rational(zenith[1], True)),
+        (0x0004, 5, 1, _rational(compass)),
+        (0x0005, 3, 1, struct.pack('<H', 0)),
+        (0x0101, 3, 4, struct.pack('<4H', 100, 0, 100, 0)),
+        (0x0102, 5, 2, _rational(Fraction(21, 10)) * 2),
+        (0x0103, 5, 2, _rational(Fraction(1, 4000)) * 2),
+        (0x0104, 2, 9, b'A0015348\0'),
+        (0x0105, 2, 9, b'A0015357\0'),
+    ]
+    makernote = [
+        (0x0001, 2, 4, b'Rdc\0'),
+        (0x0002, 2, 8, b'Rev0102\0'),
+        (0x0005, 2, 17, b'0000000000102690\0'),
+        (0x1000, 4, 1, struct.pack('<I', 2)),
+        pointer(0x4001),
+    ]
+    code = b'Ricoh\0\0\0'
+    gps = [(0x0011, 5, 1, _rational(compass))]
+    ifd0 = [pointer(0x8769), pointer(0x8825)]
+    ifd1 = [(0x0103, 3, 1, struct.pack('<H', 6)),
+            pointer(0x0201), pointer(0x0202)]
+
+    # Offsets only depend on the sizes, so lay out the blocks first
+    ifd0_offset = 8
+    exif_offset = ifd0_offset + _ifdsize(ifd0)
+    makernote_size = len(code) + _ifdsize(makernote) + _ifdsize(theta)
+    # The MakerNote is placed after the GPS IFD instead of inline
+    exif = [(0x927c, 7, makernote_size, b'\0' * 4)]
+    gps_offset = exif_offset + _ifdsize(exif)
+    makernote_offset = gps_offset + _ifdsize(gps)
+    theta_offset = makernote_offset + len(code) + _ifdsize(makernote)
+    ifd1_offset = makernote_offset + makernote_size
+    thumbnail_offset = ifd1_offset + _ifdsize(ifd1)
+
+    ifd0 = [pointer(0x8769, exif_offset), pointer(0x8825, gps_offset)]
+    makernote[-1] = pointer(0x4001, theta_offset)
+    exif = [(0x927c, 7, makernote_size, struct.pack('<I', makernote_offset))]
+    ifd1[1:] = [pointer(0x0201, thumbnail_offset),
+                pointer(0x0202, len(thumbnail))]
+
+    tiff = b'II*\0' + struct.pack('<I', ifd0_offset)
+    tiff += _ifd(ifd0, ifd0_offset, ifd1_offset)
+    tiff += _ifd(exif, exif_offset)
+    tiff += _ifd(gps, gps_offset)
+    tiff += code + _ifd(makernote, makernote_offset + len(code))
+    tiff += _ifd(theta, theta_offset)
+    tiff += _ifd(ifd1, ifd1_offset)
+    tiff += thumbnail
+    return b'Exif\0\0' + tiff
+
+
+def make_image(fp,
+               size=(1024, 512),
+               zenith=ZENITH_ES,
+               compass=COMPASS_ES,
+               thumbnail=(160, 80),
+               quality=90):
+    '''
+    Write a synthetic THETA equirectangular JPEG to a path or file object.
+
+    The image has horizontal and vertical gradients in red and green and a
+    checkerboard in blue, so rotations and shifts are visible.
+    '''
+    w, h = size
+    u = np.arange(w)
+    v = np.arange(h)[:, None]
+    pixels = np.empty((h, w, 3), np.uint8)
+    pixels[..., 0] = u * 256 // w
+    pixels[..., 1] = v * 256 // h
+    checker = np.bitwise_xor(u // 16 % 2, v // 16 % 2,
+                             out=pixels[..., 2],
+                             dtype=np.uint8,
+                             casting='unsafe')
+    checker *= 255
+    img = Image.fromarray(pixels)
+
+    buf = io.BytesIO()
+    img.resize(thumbnail, Image.BOX).save(buf, 'JPEG')
+    exif = make_exif(buf.getvalue(), zenith, compass)
+    img.save(fp, 'JPEG', exif=exif, quality=quality)
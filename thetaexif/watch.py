@@ -0,0 +1,315 @@
+'''
+Rectify images arriving in a spool directory or on a local socket.
+
+`Ingest` keeps a queue of images in front of an executor whose workers stay
+alive, so imports and coordinate caches are paid once. `Spool` polls a
+directory for files that stopped growing, and `serve` accepts paths and
+queries on a unix socket.
+'''
+import collections
+import concurrent.futures
+import contextlib
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+# Seconds of completions the recent throughput is averaged over
+RATE_WINDOW = 60
+
+
+class Spool(object):
+    '''
+    Poll `directory` for JPEG files which are completely written.
+
+    A file is reported once its size and modification time are the same in
+    two consecutive polls, or at the first poll if `settle` is False. It is
+    reported again only if it changes. Hidden files are ignored.
+    '''
+    def __init__(self, directory, settle=True):
+        self.directory = directory
+        self.settle = settle
+        self._growing = {}
+        self._reported = {}
+
+    def poll(self):
+        '''
+        Return the paths of new files in name order.
+        '''
+        current = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if (name.startswith('.') or os.path.splitext(name)[1].lower()
+                        not in JPEG_EXTENSIONS):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                current[entry.path] = st.st_size, st.st_mtime_ns
+
+        ready = []
+        for path, signature in current.items():
+            if self._reported.get(path) == signature:
+                continue
+            if not self.settle or self._growing.get(path) == signature:
+                self._reported[path] = signature
+                ready.append(path)
+        self._growing = {
+            path: signature
+            for path, signature in current.items()
+            if self._reported.get(path) != signature
+        }
+        # Forget removed files so that they are picked up if they come back
+        for path in set(self._reported) - set(current):
+            del self._reported[path]
+        return sorted(ready)
+
+
+def uptodate(src, dst):
+    '''
+    Return True if `dst` exists and is not older than `src`.
+    '''
+    try:
+        return os.stat(dst).st_mtime_ns >= os.stat(src).st_mtime_ns
+    except OSError:
+        return False
+
+
+class Ingest(object):
+    '''
+    Queue of images to rectify into `outdir`.
+
+    `submit(src, dst)` starts rectifying `src` into `dst` and returns a
+    future, e.g. on a pool of warm worker processes. Outputs are written to
+    a hidden file in `outdir` first and renamed when they are complete, so
+    readers of `outdir` never see partial images. At most `inflight` images
+    are submitted at once; the others wait in the queue.
+
+    `add` may be called from any thread. `run` collects results and submits
+    queued images until `stop` is called. `run` must not be interrupted by
+    KeyboardInterrupt, which could leave an output renamed but not
+    collected; call `stop` from signal handlers instead.
+    '''
+    def __init__(self, submit, outdir, inflight=1, log=None):
+        self.outdir = outdir
+        self.inflight = inflight
+        self._submit = submit
+        self._log = log
+        self._queue = collections.deque()
+        self._pending = {}
+        # Outputs queued or being written
+        self._active = set()
+        # Sources of the outputs queued so far
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._started = time.monotonic()
+        self._completed = collections.deque()
+        self.done = 0
+        self.failed = 0
+
+    def destination(self, src):
+        return os.path.join(self.outdir, os.path.basename(src))
+
+    def add(self, src, force=True):
+        '''
+        Queue `src` and return True, unless its output is already queued or
+        being written. If `force` is False, images whose output is up to date
+        are skipped as well.
+
+        Outputs are named after the sources, so ValueError is raised if the
+        output of `src` is the output of another source queued before.
+        '''
+        dst = self.destination(src)
+        key = os.path.normcase(os.path.abspath(src))
+        with self._lock:
+            if self._stopping:
+                return False
+            owner = self._sources.setdefault(dst, key)
+            if owner != key:
+                raise ValueError('{} is also the output of {}'.format(
+                    dst, owner))
+            if dst in self._active:
+                return False
+            if not force and uptodate(src, dst):
+                return False
+            self._active.add(dst)
+            self._queue.append((src, dst))
+        self._wakeup.set()
+        return True
+
+    def counters(self):
+        '''
+        Return the queue depth, the images being rectified, the totals and
+        the throughput in images per second overall and over the last
+        `RATE_WINDOW` seconds.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            while self._completed and self._completed[0] < now - RATE_WINDOW:
+                self._completed.popleft()
+            uptime = now - self._started
+            return {
+                'queued': len(self._queue),
+                'running': len(self._active) - len(self._queue),
+                'done': self.done,
+                'failed': self.failed,
+                'uptime': uptime,
+                'images_per_second': self.done / uptime if uptime else 0.0,
+                'recent_images_per_second':
+                len(self._completed) / min(RATE_WINDOW, uptime or 1),
+            }
+
+    def idle(self):
+        with self._lock:
+            return not self._active
+
+    def step(self):
+        '''
+        Collect finished images and submit queued ones.
+        '''
+        self._wakeup.clear()
+        self._collect()
+        with self._lock:
+            if self._stopping:
+                for _, dst in self._queue:
+                    self._active.discard(dst)
+                self._queue.clear()
+            jobs = []
+            free = self.inflight - len(self._pending)
+            while self._queue and len(jobs) < free:
+                jobs.append(self._queue.popleft())
+        for src, dst in jobs:
+            self._start(src, dst)
+        if jobs:
+            # Serial executors have finished already
+            self._collect()
+
+    def stop(self):
+        '''
+        Stop accepting images. Queued images are dropped and images being
+        rectified are finished by `run`, which notices the stop within its
+        `interval`.
+
+        Only a flag is set, so `stop` may be called from signal handlers,
+        which can interrupt the thread while it holds a lock.
+        '''
+        self._stopping = True
+
+    def run(self, poll=None, interval=1.0, once=False):
+        '''
+        Process images until `stop` is called.
+
+        `poll()` is called every `interval` seconds to add new images. If
+        `once` is True, `run` returns when nothing is left to do.
+        '''
+        deadline = time.monotonic()
+        while True:
+            due = poll is not None and time.monotonic() >= deadline
+            if due and not self._stopping:
+                poll()
+                deadline = time.monotonic() + interval
+            self.step()
+            if (self._stopping or once) and self.idle():
+                return
+            # Woken up early by finished and added images
+            if poll is not None:
+                self._wakeup.wait(max(0, deadline - time.monotonic()))
+            else:
+                self._wakeup.wait(interval)
+
+    def _start(self, src, dst):
+        directory, name = os.path.split(dst)
+        tmp = os.path.join(directory, '.{}.part'.format(name))
+        try:
+            future = self._submit(src, tmp)
+        except Exception as e:
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        with self._lock:
+            self._pending[future] = src, dst, tmp
+        future.add_done_callback(lambda _: self._wakeup.set())
+
+    def _collect(self):
+        with self._lock:
+            finished = [f for f in self._pending if f.done()]
+        for future in finished:
+            src, dst, tmp = self._pending[future]
+            error = future.exception()
+            if error is None:
+                try:
+                    os.replace(tmp, dst)
+                except OSError as e:
+                    error = e
+            if error is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+            with self._lock:
+                del self._pending[future]
+                self._active.discard(dst)
+                if error is None:
+                    self.done += 1
+                    self._completed.append(time.monotonic())
+                else:
+                    self.failed += 1
+            if self._log is not None:
+                self._log(src, dst, error)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        ingest = self.server.ingest
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            if line == 'stats':
+                reply = ingest.counters()
+            elif not os.path.isabs(line):
+                reply = {'path': line, 'error': 'path is not absolute'}
+            elif not os.path.isfile(line):
+                reply = {'path': line, 'error': 'no such file'}
+            else:
+                try:
+                    reply = {'path': line, 'queued': ingest.add(line)}
+                except ValueError as e:
+                    reply = {'path': line, 'error': str(e)}
+                else:
+                    reply['depth'] = ingest.counters()['queued']
+            self.wfile.write(json.dumps(reply, sort_keys=True).encode() +
+                             b'\n')
+
+
+def serve(ingest, path):
+    '''
+    Start a thread accepting requests for `ingest` on a unix socket.
+
+    Each line of a connection is an absolute path of an image to queue, or
+    `stats` to get the counters. Every line is answered by a JSON object on
+    a line. Returns the server, whose `shutdown` stops it.
+
+    A socket left at `path` by an earlier server is replaced. ValueError is
+    raised if anything else exists there.
+    '''
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        pass
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            raise ValueError('{}: exists and is not a socket'.format(path))
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, _Handler)
+    server.daemon_threads = True
+    server.ingest = ingest
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server